@@ -0,0 +1,94 @@
+import os
+import hashlib
+import numpy as np
+
+
+class ResponseCache:
+    """
+    matchTemplate response maps on disk, as float16 .npy files loaded with
+    mmap. Keyed by image content, template and binarization parameters, so
+    only the peak picking reruns when the match threshold changes.
+    """
+
+    def __init__(self, cache_dir, max_mb=20480):
+        self.cache_dir = cache_dir
+        self.max_mb = max_mb
+        if not os.path.exists(cache_dir):
+            os.makedirs(cache_dir, exist_ok=True)
+
+    def key(self, data, t, *params):
+        h = hashlib.blake2b(digest_size=16)
+        h.update(data)
+        h.update(np.ascontiguousarray(t).tobytes())
+        h.update(repr((t.shape,) + params).encode())
+        return h.hexdigest()
+
+    def path(self, key):
+        return os.path.join(self.cache_dir, f"{key}.npy")
+
+    def load(self, key):
+        path = self.path(key)
+        if not os.path.exists(path):
+            return None
+        os.utime(path)  # mark as recently used
+        return np.load(path, mmap_mode="r")
+
+    def save(self, key, result):
+        path = self.path(key)
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        arr = np.lib.format.open_memmap(
+            tmp_path, mode="w+", dtype=np.float16, shape=result.shape
+        )
+        arr[:] = result
+        arr.flush()
+        del arr
+        os.replace(tmp_path, path)
+        self.prune()
+        return np.load(path, mmap_mode="r")
+
+    def prune(self):
+        # drop the least recently used maps beyond max_mb
+        files = []
+        for name in os.listdir(self.cache_dir):
+            if not name.endswith(".npy"):
+                continue
+            path = os.path.join(self.cache_dir, name)
+            try:
+                stat = os.stat(path)
+            except FileNotFoundError:
+                continue
+            files.append((stat.st_mtime, stat.st_size, path))
+        total = sum(size for _, size, _ in files)
+        for _, size, path in sorted(files):
+            if total <= self.max_mb * 1024 * 1024:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total -= size
+
+
+def fileDigest(path):
+    h = hashlib.blake2b(digest_size=16)
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def fileFingerprint(path, old=None, data=None):
+    """
+    Size, mtime and content digest of a file. The digest of old is reused
+    when size and mtime did not change, so unchanged files are not read.
+    data, the file bytes, is hashed instead of reading the file again.
+    """
+    stat = os.stat(path)
+    fingerprint = {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns}
+    if old and all(old.get(k) == v for k, v in fingerprint.items()):
+        fingerprint["digest"] = old["digest"]
+    elif data is not None:
+        fingerprint["digest"] = hashlib.blake2b(data, digest_size=16).hexdigest()
+    else:
+        fingerprint["digest"] = fileDigest(path)
+    return fingerprint
@@ -0,0 +1,133 @@
+import os
+import glob
+import queue
+import threading
+
+import torch
+from torch import nn
+
+from ._nets import MODELS, headKind, headFeatures, makeHead, setHead
+
+
+def cpuCopy(state):
+    """A copy of a nested state dict, every tensor cloned to the CPU."""
+    if isinstance(state, torch.Tensor):
+        return state.detach().to("cpu", copy=True)
+    if isinstance(state, dict):
+        return {key: cpuCopy(value) for key, value in state.items()}
+    if isinstance(state, (list, tuple)):
+        return type(state)(cpuCopy(value) for value in state)
+    return state
+
+
+def numClasses(model):
+    # every model type ends with its linear classifier
+    return [m for m in model.modules() if isinstance(m, nn.Linear)][-1].out_features
+
+
+def modelState(model, model_type, precision="fp32"):
+    """What a model file holds, rebuilt by readModel."""
+    return {
+        "model_type": model_type,
+        "num_classes": numClasses(model),
+        "precision": precision,  # weights stay fp32, this is the autocast it trained with
+        "head": headKind(model),
+        "model_state": model.state_dict(),
+    }
+
+
+def buildModel(state):
+    model = MODELS[state["model_type"]](state["num_classes"])
+    if state.get("head", "linear") != "linear":
+        setHead(model, makeHead(state["head"], headFeatures(model), state["num_classes"]))
+    model.load_state_dict(state["model_state"])
+    return model
+
+
+def readModel(path, map_location=None):
+    """
+    The model of a .pth file, either a state written by modelState or, for
+    files of older versions, a whole pickled model.
+    """
+    obj = torch.load(path, weights_only=False, map_location=map_location)
+    if isinstance(obj, dict) and "model_state" in obj:
+        obj = buildModel(obj)
+        if map_location is not None:
+            obj.to(map_location)
+    return obj
+
+
+def checkpointInfo(path):
+    """The run, epoch and end of a checkpoint, its tensors are only mapped."""
+    state = torch.load(path, weights_only=False, map_location="cpu", mmap=True)
+    return {
+        "path": path,
+        "model_type": state["model_type"],
+        "time": state["time"],
+        "epoch": state["epoch"],
+        "precision": state.get("precision", "fp32"),
+        # older checkpoints did not record it, an early stop ended the run
+        "finished": state.get("finished", state["train_report"].get("early_stop", False)),
+    }
+
+
+def stoppedCheckpoint(checkpoint_dir):
+    """checkpointInfo of the last checkpoint of the newest stopped run, or None."""
+    runs = {}
+    for path in glob.glob(os.path.join(checkpoint_dir, "*.ckpt")):
+        runs.setdefault(os.path.basename(path).rpartition("_epoch")[0], []).append(path)
+    # epochs are zero-padded, the last checkpoint of a run tells how it ended
+    for path in sorted((max(paths) for paths in runs.values()), key=os.path.getmtime, reverse=True):
+        info = checkpointInfo(path)
+        if not info["finished"]:
+            return info
+    return None
+
+
+class CheckpointWriter:
+    """
+    Save files on a background thread, so training goes on while they are
+    written.
+
+    States are handed over as CPU copies. At most one save waits behind the
+    running one, a third blocks the caller. Files are written to a temporary
+    name and swapped in, and only the newest keep files matching a save's
+    pattern are left.
+    """
+
+    def __init__(self, keep=3):
+        self.keep = keep
+        self.error = None
+        self.queue = queue.Queue(maxsize=1)
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def save(self, state, path, pattern=None):
+        self.queue.put((cpuCopy(state), path, pattern))
+
+    def close(self):
+        """Wait for the pending saves, return the first error or None."""
+        self.queue.put(None)
+        self.thread.join()
+        return self.error
+
+    def _run(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                return
+            state, path, pattern = item
+            try:
+                torch.save(state, path + ".tmp")
+                os.replace(path + ".tmp", path)
+                if pattern:
+                    self._prune(pattern)
+            # torch.save reports a missing directory or a full disk as a
+            # RuntimeError, any error must leave the thread taking saves
+            except Exception as e:
+                self.error = self.error or e
+
+    def _prune(self, pattern):
+        paths = sorted(glob.glob(pattern))
+        for path in paths[: max(len(paths) - self.keep, 0)]:
+            os.remove(path)
@@ -0,0 +1,186 @@
+import os
+import json
+import time
+import hashlib
+import cv2
+import numpy as np
+
+# no torch here, so decode workers only load OpenCV and numpy, spawned
+# children also import the parent's main module, which main.py keeps light
+
+
+def cropWells(img, wells_loc, size=32):
+    """Resize every well straight into one uint8 N x size x size x 3 buffer."""
+    crops = np.empty((len(wells_loc), size, size, 3), dtype=np.uint8)
+    for i, (x, y, w, h) in enumerate(wells_loc):
+        cv2.resize(img[y : y + h, x : x + w], (size, size), dst=crops[i])
+    return crops
+
+
+def readWellsLoc(extract_path):
+    wells_loc = []
+    with open(extract_path, "r") as f:
+        lines = f.readlines()
+        for line in lines:
+            x, y, w, h, label = map(int, line.split(","))
+            wells_loc.append((x, y, w, h))
+    return wells_loc
+
+
+def readEdit(edit_path):
+    """Rects and int64 labels of an edit file."""
+    rects, labels = [], []
+    with open(edit_path, "r") as f:
+        for line in f.readlines():
+            x, y, w, h, label = map(int, line.split(","))
+            rects.append((x, y, w, h))
+            labels.append(label)
+    return rects, np.array(labels, dtype=np.int64)
+
+
+def loadCrops(img_path, extract_path):
+    """Decode, parse and crop one image, with the time of each stage."""
+    start = time.perf_counter()
+    img = cv2.imdecode(np.fromfile(img_path, dtype=np.uint8), cv2.IMREAD_COLOR)
+    decoded = time.perf_counter()
+    wells_loc = readWellsLoc(extract_path)
+    parsed = time.perf_counter()
+    crops = cropWells(img, wells_loc)
+    timing = {
+        "decode": decoded - start,
+        "parse": parsed - decoded,
+        "crop": time.perf_counter() - parsed,
+    }
+    return wells_loc, crops, timing
+
+
+class WellStore:
+    """
+    Well crops of a workspace in one memory-mapped N x 32 x 32 x 3 uint8
+    array, with the rect of every row in a parallel N x 4 int32 array.
+
+    The index maps an image and its rect source (extraction or edit) to a run
+    of rows, stamped with the image size and mtime and a digest of the rects.
+    A run is only used while both are unchanged, otherwise the image gets a
+    new run at the end. Stale rows are dropped once they are half the array.
+    Puts only update the index in memory, flush saves it once per batch.
+    """
+
+    SIZE = 32
+
+    def __init__(self, store_dir, readonly=False):
+        self.store_dir = store_dir
+        self.readonly = readonly
+        self.P_WELLS = os.path.join(store_dir, "wells.u8")
+        self.P_RECTS = os.path.join(store_dir, "rects.i32")
+        self.P_INDEX = os.path.join(store_dir, "index.json")
+        self.index = {"rows": 0, "runs": {}}
+        self.changed = False
+        if os.path.exists(self.P_INDEX):
+            with open(self.P_INDEX, "r") as f:
+                self.index = json.load(f)
+
+    def stamp(self, img_path, rects):
+        stat = os.stat(img_path)
+        rects = np.asarray(rects, dtype=np.int32).reshape(-1, 4)
+        digest = hashlib.blake2b(rects.tobytes(), digest_size=16).hexdigest()
+        return {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns, "rects": digest}
+
+    def has(self, img_name, source, img_path, rects):
+        run = self.index["runs"].get(f"{source}/{img_name}")
+        return run is not None and run["stamp"] == self.stamp(img_path, rects)
+
+    def rows(self, img_name, source):
+        """Row numbers of an image's run, valid until the next put."""
+        run = self.index["runs"][f"{source}/{img_name}"]
+        return np.arange(run["start"], run["start"] + run["count"])
+
+    def get(self, img_name, source, img_path, rects):
+        """Stored crops of the image, or None if missing or stale."""
+        if not self.has(img_name, source, img_path, rects):
+            return None
+        run = self.index["runs"][f"{source}/{img_name}"]
+        # copied out, so no map stays open while the files are rewritten
+        return np.array(self.wells()[run["start"] : run["start"] + run["count"]])
+
+    def put(self, img_name, source, img_path, rects, crops):
+        if self.readonly:
+            return
+        if not os.path.exists(self.store_dir):
+            os.makedirs(self.store_dir, exist_ok=True)
+
+        # rows past the index, left by an interrupted or unflushed put, are overwritten
+        start = self.index["rows"]
+        rects = np.asarray(rects, dtype=np.int32).reshape(-1, 4)
+        self._write(self.P_WELLS, start * self.SIZE * self.SIZE * 3, crops)
+        self._write(self.P_RECTS, start * 16, rects)
+        self.index["rows"] = start + len(crops)
+        self.index["runs"][f"{source}/{img_name}"] = {
+            "start": start,
+            "count": len(crops),
+            "stamp": self.stamp(img_path, rects),
+        }
+
+        self.changed = True
+
+        num_live = sum(run["count"] for run in self.index["runs"].values())
+        if num_live * 2 < self.index["rows"]:
+            self.compact()
+
+    def flush(self):
+        """Save the index if puts changed it, rows past the saved index are unused."""
+        if self.changed:
+            self._saveIndex()
+
+    def load(self, img_name, source, img_path, rects, img=None):
+        """Crops of the rects, from the store or cut from the image once."""
+        crops = self.get(img_name, source, img_path, rects)
+        if crops is None:
+            if img is None:
+                img = cv2.imdecode(np.fromfile(img_path, dtype=np.uint8), cv2.IMREAD_COLOR)
+            crops = cropWells(img, rects, self.SIZE)
+            self.put(img_name, source, img_path, rects, crops)
+        return crops
+
+    def wells(self):
+        return self._map(self.P_WELLS, np.uint8, (self.SIZE, self.SIZE, 3))
+
+    def rects(self):
+        return self._map(self.P_RECTS, np.int32, (4,))
+
+    def compact(self):
+        wells, rects = self.wells(), self.rects()
+        runs = sorted(self.index["runs"].values(), key=lambda run: run["start"])
+        with open(self.P_WELLS + ".tmp", "wb") as f_wells, open(
+            self.P_RECTS + ".tmp", "wb"
+        ) as f_rects:
+            start = 0
+            for run in runs:
+                rows = slice(run["start"], run["start"] + run["count"])
+                f_wells.write(np.ascontiguousarray(wells[rows]).tobytes())
+                f_rects.write(np.ascontiguousarray(rects[rows]).tobytes())
+                run["start"] = start
+                start += run["count"]
+        del wells, rects
+        os.replace(self.P_WELLS + ".tmp", self.P_WELLS)
+        os.replace(self.P_RECTS + ".tmp", self.P_RECTS)
+        self.index["rows"] = start
+        self._saveIndex()
+
+    def _map(self, path, dtype, row_shape):
+        rows = self.index["rows"]
+        if rows == 0 or not os.path.exists(path):
+            return np.empty((0,) + row_shape, dtype=dtype)
+        return np.memmap(path, dtype=dtype, mode="r", shape=(rows,) + row_shape)
+
+    def _write(self, path, offset, arr):
+        with open(path, "r+b" if os.path.exists(path) else "wb") as f:
+            f.seek(offset)
+            f.write(np.ascontiguousarray(arr).tobytes())
+            f.truncate()
+
+    def _saveIndex(self):
+        with open(self.P_INDEX + ".tmp", "w") as f:
+            json.dump(self.index, f)
+        os.replace(self.P_INDEX + ".tmp", self.P_INDEX)
+        self.changed = False
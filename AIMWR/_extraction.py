@@ -0,0 +1,157 @@
+import os
+import hashlib
+import cv2
+import numpy as np
+
+from ._matching import findPeaks, pyramidPeaks, latticePeaks
+from ._cache import ResponseCache, fileFingerprint
+from ._tiles import GrayImage, tiledPeaks
+
+# no torch here, so extraction workers only load OpenCV and numpy
+
+# default cap on worker processes, each holds a decoded image and its response map
+MAX_WORKERS = 8
+
+
+class Extractor:
+    MODES = ["exhaustive", "pyramid", "grid"]
+
+    def __init__(self, dir, template_path, mode="exhaustive", cache_dir=None):
+        self.dir = dir
+        self.mode = mode
+        self.t = None
+        if os.path.exists(template_path):
+            self.t = cv2.imdecode(
+                np.fromfile(template_path, dtype=np.uint8), cv2.IMREAD_GRAYSCALE
+            )
+
+        # extraction parameters
+        self.match_thre = 0.15
+        self.block_size = 25
+        self.block_c = 10
+        self.memory_mb = 0  # memory budget of tiled extraction, 0 for untiled
+        self.cache = ResponseCache(cache_dir) if cache_dir else None
+
+    def resetTemplate(self, template_path):
+        if os.path.exists(template_path):
+            self.t = cv2.imdecode(
+                np.fromfile(template_path, dtype=np.uint8), cv2.IMREAD_GRAYSCALE
+            )
+
+    def loadSettings(self, info_c):
+        # mode and parameters saved in the workspace metadata
+        self.mode = info_c.getSetting("extract_mode", "exhaustive")
+        self.match_thre = info_c.getSetting("match_thre", 0.15)
+        self.block_size = info_c.getSetting("block_size", 25)
+        self.block_c = info_c.getSetting("block_c", 10)
+        self.memory_mb = info_c.getSetting("tile_memory_mb", 0)
+        self.cache = None
+        if info_c.getSetting("cache_response", False):
+            self.cache = ResponseCache(os.path.join(info_c.P_CACHE, "response"))
+
+    def paramsDigest(self):
+        # everything besides the image that changes the extraction result
+        h = hashlib.blake2b(digest_size=16)
+        h.update(np.ascontiguousarray(self.t).tobytes())
+        params = (
+            self.t.shape,
+            self.mode,
+            self.match_thre,
+            self.block_size,
+            self.block_c,
+            self.memory_mb,
+            # cached maps are float16, their peaks can differ from float32 ones
+            self.cache is not None,
+        )
+        h.update(repr(params).encode())
+        return h.hexdigest()
+
+    def binarize(self, src_color):
+        src_gray = cv2.cvtColor(src_color, cv2.COLOR_BGR2GRAY)
+
+        img_binary = cv2.adaptiveThreshold(
+            src_gray,
+            255,
+            cv2.ADAPTIVE_THRESH_MEAN_C,
+            cv2.THRESH_BINARY,
+            self.block_size,
+            self.block_c,
+        )
+        return img_binary
+
+    def wellExtract(self, img_name: str, data=None, src_color=None):
+        """
+        Find wells in an image. data (file bytes) and src_color (decoded
+        image) can be passed in when the caller already has them.
+        """
+        img_path = os.path.join(self.dir, img_name)
+
+        # memory-bounded path for very large images, never decodes in color
+        # more than once and never holds the whole response map
+        if self.mode == "exhaustive" and self.memory_mb > 0:
+            image = GrayImage(img_path, data, src_color)
+            return tiledPeaks(
+                image,
+                self.t,
+                self.match_thre,
+                self.block_size,
+                self.block_c,
+                self.memory_mb,
+            )
+
+        if data is None:
+            data = np.fromfile(img_path, dtype=np.uint8)
+
+        # cached response maps only need the peak picking to run again
+        if self.mode == "exhaustive" and self.cache is not None:
+            key = self.cache.key(data, self.t, self.block_size, self.block_c)
+            result = self.cache.load(key)
+            if result is None:
+                if src_color is None:
+                    src_color = cv2.imdecode(data, cv2.IMREAD_COLOR)
+                img_binary = self.binarize(src_color)
+                result = cv2.matchTemplate(img_binary, self.t, cv2.TM_CCOEFF_NORMED)
+                result = self.cache.save(key, result)
+            return findPeaks(result, self.t.shape, self.match_thre)
+
+        if src_color is None:
+            src_color = cv2.imdecode(data, cv2.IMREAD_COLOR)
+        img_binary = self.binarize(src_color)
+
+        if self.mode == "pyramid":
+            return pyramidPeaks(img_binary, self.t, self.match_thre)
+        if self.mode == "grid":
+            # (x, y, row, col), falls back to matching if no lattice is found
+            wells_loc = latticePeaks(img_binary, self.t, self.match_thre)
+            if wells_loc is not None:
+                return wells_loc
+
+        result = cv2.matchTemplate(img_binary, self.t, cv2.TM_CCOEFF_NORMED)
+
+        wells_loc = findPeaks(result, self.t.shape, self.match_thre)
+        return wells_loc
+
+
+def extractImage(extractor, img_name, old_fingerprint=None):
+    """(img_name, wells_loc, fingerprint), wells_loc is None when up to date."""
+    # old_fingerprint is given in incremental mode, skip if inputs are the same
+    img_path = os.path.join(extractor.dir, img_name)
+    fingerprint = fileFingerprint(img_path, old_fingerprint)
+    fingerprint["params"] = extractor.paramsDigest()
+    if old_fingerprint and all(
+        fingerprint[k] == old_fingerprint.get(k) for k in ("digest", "params")
+    ):
+        return img_name, None, fingerprint
+    return img_name, extractor.wellExtract(img_name), fingerprint
+
+
+_worker_extractor = None
+
+
+def initExtractWorker(extractor):
+    global _worker_extractor
+    _worker_extractor = extractor
+
+
+def extractWorker(img_name, old_fingerprint=None):
+    return extractImage(_worker_extractor, img_name, old_fingerprint)
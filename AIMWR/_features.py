@@ -0,0 +1,61 @@
+import os
+import json
+import hashlib
+
+import numpy as np
+import torch
+from torch import nn
+
+from ._nets import getHead, setHead, headFeatures
+
+
+def backboneKey(model_path):
+    stat = os.stat(model_path)
+    key = f"{os.path.abspath(model_path)}|{stat.st_size}|{stat.st_mtime_ns}"
+    return hashlib.blake2b(key.encode(), digest_size=16).hexdigest()
+
+
+def embed(model, wells_tensor, batch_size=256):
+    """Penultimate-layer features of normalized wells, in eval mode."""
+    if not len(wells_tensor):
+        return np.zeros((0, headFeatures(model)), dtype=np.float32)
+    head = getHead(model)
+    setHead(model, nn.Identity())
+    try:
+        model.eval()
+        with torch.no_grad():
+            features = [model(batch).float().cpu() for batch in wells_tensor.split(batch_size)]
+    finally:
+        setHead(model, head)
+    return torch.cat(features).numpy()
+
+
+class FeatureCache:
+    """
+    Features of edited wells, one file per backbone and image.
+
+    The backbone is keyed by its model file, an image by the well store
+    stamp of its file and rects, so relabelling wells keeps the features.
+    """
+
+    def __init__(self, cache_dir, model_path):
+        self.dir = os.path.join(cache_dir, backboneKey(model_path))
+        os.makedirs(self.dir, exist_ok=True)
+
+    def path(self, img_name):
+        return os.path.join(self.dir, f"{img_name}.npz")
+
+    def get(self, img_name, stamp):
+        path = self.path(img_name)
+        if not os.path.exists(path):
+            return None
+        with np.load(path) as data:
+            if json.loads(str(data["stamp"])) != stamp:
+                return None
+            return data["features"]
+
+    def put(self, img_name, stamp, features):
+        # swapped in whole, a crash leaves the old file or none
+        path = self.path(img_name)
+        np.savez(path + ".tmp.npz", stamp=json.dumps(stamp), features=features)
+        os.replace(path + ".tmp.npz", path)
@@ -0,0 +1,263 @@
+import os
+import threading
+import contextlib
+from collections import OrderedDict, deque
+
+import numpy as np
+import torch
+
+from ._checkpoint import readModel
+from ._crops import WellStore, readWellsLoc, loadCrops
+from ._optimize import artifactPath
+
+# no PySide6 here, so classification shards only load torch
+MAX_BATCH_SIZE = 4096
+# fp16 is for CUDA, CPUs without fp16 units run it slower than fp32
+PRECISIONS = ["fp32", "bf16", "fp16"]
+
+
+def modelBytes(model):
+    tensors = list(model.parameters()) + list(model.buffers())
+    return sum(t.numel() * t.element_size() for t in tensors)
+
+
+class ModelCache:
+    """
+    Models kept loaded across runs, least recently used first out.
+
+    Entries are keyed by path, mtime and device and hold the model already on
+    the device in eval mode. A changed file replaces its stale entries.
+    """
+
+    def __init__(self, max_models=2, max_mb=2048):
+        self.max_models = max_models
+        self.max_mb = max_mb
+        self.models = OrderedDict()
+        self.lock = threading.Lock()
+
+    def setLimits(self, max_models, max_mb):
+        with self.lock:
+            self.max_models = max_models
+            self.max_mb = max_mb
+            self._prune()
+
+    def get(self, model_path, device, load=None):
+        path = os.path.abspath(model_path)
+        key = (path, os.stat(path).st_mtime_ns, str(device))
+        with self.lock:
+            if key in self.models:
+                self.models.move_to_end(key)
+                return self.models[key][0]
+
+        if load is not None:
+            model = load(path, map_location=device)
+        else:
+            model = readModel(path, map_location=device)
+        model.to(device)
+        model.eval()
+
+        with self.lock:
+            for old_key in [k for k in self.models if k[0] == path and k[1] != key[1]]:
+                del self.models[old_key]
+            self.models[key] = (model, modelBytes(model))
+            self._prune()
+        return model
+
+    def clear(self):
+        with self.lock:
+            self.models.clear()
+
+    def _prune(self):
+        if self.max_models == 0:
+            self.models.clear()
+            return
+        # the newest entry stays, even if it alone is over the memory limit
+        total = sum(size for _, size in self.models.values())
+        while len(self.models) > 1 and (
+            len(self.models) > self.max_models or total > self.max_mb * 1024 * 1024
+        ):
+            _, (_, size) = self.models.popitem(last=False)
+            total -= size
+
+
+MODEL_CACHE = ModelCache()
+
+
+def loadModel(model_path, device, load=None):
+    return MODEL_CACHE.get(model_path, device, load)
+
+
+def autocast(device, precision):
+    """Mixed precision for the forward pass, nothing for fp32."""
+    if precision == "fp16" and device.type != "cuda":
+        raise ValueError("fp16 needs CUDA, use bf16 on the CPU.")
+    if precision == "fp32":
+        return contextlib.nullcontext()
+    dtype = torch.bfloat16 if precision == "bf16" else torch.float16
+    return torch.autocast(device.type, dtype=dtype)
+
+
+def activationBytes(model, device, size=32):
+    """Bytes of all layer outputs for one well, measured with forward hooks."""
+    total = 3 * size * size * 4
+
+    def hook(module, inputs, output):
+        nonlocal total
+        if isinstance(output, torch.Tensor):
+            total += output.numel() * output.element_size()
+
+    leaves = [m for m in model.modules() if not list(m.children())]
+    handles = [m.register_forward_hook(hook) for m in leaves]
+    try:
+        with torch.no_grad():
+            model(torch.zeros(1, 3, size, size, device=device))
+    finally:
+        for handle in handles:
+            handle.remove()
+    return total
+
+
+def autoBatchSize(model, device, memory_mb):
+    """Largest batch whose activations fit memory_mb (and free GPU memory)."""
+    budget = memory_mb * 1024 * 1024
+    if device.type == "cuda":
+        free, _ = torch.cuda.mem_get_info(device)
+        budget = min(budget, free * 0.8)
+    # no_grad frees most outputs early, so the sum over layers is an upper bound
+    batch_size = int(budget // activationBytes(model, device))
+    return min(max(batch_size, 1), MAX_BATCH_SIZE)
+
+
+class WellBatcher:
+    """
+    Stream the wells of many images through fixed-size batches.
+
+    Crops are queued image after image, every batch takes the next
+    batch_size wells wherever they come from, and predictions are scattered
+    back until an image is complete. Images finish in the order they were
+    added.
+    """
+
+    def __init__(self, batch_size):
+        self.batch_size = max(int(batch_size), 1)
+        self.images = deque()
+        self.chunks = deque()
+        self.num_queued = 0
+
+    def add(self, img_name, wells_loc, crops):
+        image = {
+            "img_name": img_name,
+            "wells_loc": wells_loc,
+            "predicted": np.zeros(len(wells_loc), dtype=np.int64),
+            "num_left": len(wells_loc),
+        }
+        self.images.append(image)
+        if len(wells_loc):
+            self.chunks.append({"image": image, "crops": crops, "start": 0})
+            self.num_queued += len(wells_loc)
+
+    def isFull(self):
+        return self.num_queued >= self.batch_size
+
+    def isEmpty(self):
+        return self.num_queued == 0
+
+    def nextBatch(self):
+        """Up to batch_size queued crops, and the (image, start, stop) parts."""
+        crops, parts = [], []
+        size = 0
+        while self.chunks and size < self.batch_size:
+            chunk = self.chunks[0]
+            start = chunk["start"]
+            stop = min(start + self.batch_size - size, len(chunk["crops"]))
+            crops.append(chunk["crops"][start:stop])
+            parts.append((chunk["image"], start, stop))
+            size += stop - start
+            if stop == len(chunk["crops"]):
+                self.chunks.popleft()
+            else:
+                chunk["start"] = stop
+        self.num_queued -= size
+        batch = crops[0] if len(crops) == 1 else np.concatenate(crops)
+        return batch, parts
+
+    def scatter(self, parts, predicted):
+        offset = 0
+        for image, start, stop in parts:
+            image["predicted"][start:stop] = predicted[offset : offset + stop - start]
+            image["num_left"] -= stop - start
+            offset += stop - start
+
+    def popFinished(self):
+        """(img_name, wells_loc, predicted) of the completed leading images."""
+        finished = []
+        while self.images and self.images[0]["num_left"] == 0:
+            image = self.images.popleft()
+            finished.append((image["img_name"], image["wells_loc"], image["predicted"]))
+        return finished
+
+
+def normalizeWells(crops):
+    """uint8 N x H x W x 3 crops to the normalized N x 3 x H x W float tensor."""
+    wells_tensor = torch.from_numpy(crops).permute(0, 3, 1, 2).contiguous().float()
+    # same ops as ToTensor + Normalize(0.5, 0.5), so the values are identical
+    return wells_tensor.div_(255.0).sub_(0.5).div_(0.5)
+
+
+def classifyBatch(model, batcher, device, precision="fp32"):
+    # one fixed-size batch through the model, predictions back to their images
+    crops, parts = batcher.nextBatch()
+    with torch.no_grad(), autocast(device, precision):
+        output = model(normalizeWells(crops).to(device))
+        _, predicted = torch.max(output, 1)
+    batcher.scatter(parts, predicted.cpu().numpy())
+
+
+def classifyShard(
+    cores, model_path, cpu_mode, precision, jobs, batch_size, store_dir, queue, stop_event
+):
+    # pinned to its own cores, with one intra-op thread per core, a failure
+    # is sent back with the images this shard did not finish
+    done = set()
+    try:
+        if hasattr(os, "sched_setaffinity"):
+            os.sched_setaffinity(0, cores)
+        torch.set_num_threads(len(cores))
+        device = torch.device("cpu")
+        if cpu_mode == "fp32":
+            model = loadModel(model_path, device)
+        else:
+            model = loadModel(artifactPath(model_path, cpu_mode), device, torch.jit.load)
+
+        # the store is only read here, the thread fills it on the next single run
+        store = WellStore(store_dir, readonly=True)
+        batcher = WellBatcher(batch_size)
+        for img_name, img_path, extract_path in jobs:
+            if stop_event.is_set():
+                break
+            # an unreadable image fails alone, the shard goes on
+            try:
+                wells_loc = readWellsLoc(extract_path)
+                crops = store.get(img_name, "extraction", img_path, wells_loc)
+                if crops is None:
+                    wells_loc, crops, _ = loadCrops(img_path, extract_path)
+            except Exception as e:
+                queue.put({"error": f"{type(e).__name__}: {e}", "img_names": [img_name]})
+                done.add(img_name)
+                continue
+            batcher.add(img_name, wells_loc, crops)
+            while batcher.isFull():
+                classifyBatch(model, batcher, device, precision)
+            for finished in batcher.popFinished():
+                queue.put(finished)
+                done.add(finished[0])
+        while not batcher.isEmpty() and not stop_event.is_set():
+            classifyBatch(model, batcher, device, precision)
+        for finished in batcher.popFinished():
+            queue.put(finished)
+            done.add(finished[0])
+    except Exception as e:
+        img_names = [img_name for img_name, _, _ in jobs if img_name not in done]
+        queue.put({"error": f"{type(e).__name__}: {e}", "img_names": img_names})
+    finally:
+        queue.put(None)
@@ -0,0 +1,316 @@
+import cv2
+import numpy as np
+
+
+def _boxKernel(half_x, half_y):
+    return np.ones((2 * half_y + 1, 2 * half_x + 1), dtype=np.uint8)
+
+
+def findPeaks(result, t_shape, match_thre, return_values=False):
+    """
+    Find wells in a matchTemplate response map.
+
+    Gives the same wells, in the same order, as repeatedly taking
+    cv2.minMaxLoc and blanking a template sized box around the maximum.
+    Each round accepts every pixel that is the first maximum (row-major) of
+    its own suppression box, as the greedy loop always picks those, then
+    blanks all their boxes at once.
+    """
+    # same box as the original loop: x uses shape[0], y uses shape[1]
+    half_x, half_y = t_shape[0] // 2, t_shape[1] // 2
+    kernel = _boxKernel(half_x, half_y)
+
+    # one-sided kernels covering the rows above and the pixels to the left
+    kernel_up = np.zeros((half_y + 1, 2 * half_x + 1), dtype=np.uint8)
+    kernel_up[:half_y] = 1
+    kernel_left = np.zeros((1, half_x + 1), dtype=np.uint8)
+    kernel_left[0, :half_x] = 1
+
+    res = np.array(result, dtype=np.float32, copy=True)
+    xs_all, ys_all, vals_all = [], [], []
+    while True:
+        dilated = cv2.dilate(res, kernel)
+        cand = (res >= dilated) & (res >= match_thre)
+        ys, xs = np.nonzero(cand)
+        if len(xs) == 0:
+            break
+        vals = res[ys, xs]
+
+        # drop candidates with an equal value earlier in row-major order
+        if half_y > 0:
+            up = cv2.dilate(res, kernel_up, anchor=(half_x, half_y))
+            first = up[ys, xs] < vals
+        else:
+            first = np.ones(len(xs), dtype=bool)
+        if half_x > 0:
+            left = cv2.dilate(res, kernel_left, anchor=(half_x, 0))
+            first &= left[ys, xs] < vals
+        xs, ys, vals = xs[first], ys[first], vals[first]
+
+        xs_all.append(xs)
+        ys_all.append(ys)
+        vals_all.append(vals)
+
+        mask = np.zeros(res.shape, dtype=np.uint8)
+        mask[ys, xs] = 1
+        res[cv2.dilate(mask, kernel) > 0] = 0
+
+    xs = np.concatenate(xs_all) if xs_all else np.zeros(0, dtype=np.int64)
+    ys = np.concatenate(ys_all) if ys_all else np.zeros(0, dtype=np.int64)
+    vals = np.concatenate(vals_all) if vals_all else np.zeros(0, dtype=np.float32)
+
+    # the greedy loop picks by value, then row-major for equal values
+    order = np.lexsort((xs, ys, -vals))
+    wells_loc = [(int(xs[i]), int(ys[i])) for i in order]
+    if return_values:
+        return wells_loc, vals[order]
+    return wells_loc
+
+
+def pyramidLevels(t_shape, min_size=8, max_levels=3):
+    """Number of halvings that keep the template at least min_size pixels."""
+    levels = 0
+    while levels < max_levels and min(t_shape) >> (levels + 1) >= min_size:
+        levels += 1
+    return levels
+
+
+def suppressPoints(xs, ys, vals, t_shape, match_thre):
+    """
+    Greedy suppression over a short list of scored points, with the same
+    box and ordering as findPeaks.
+    """
+    half_x, half_y = t_shape[0] // 2, t_shape[1] // 2
+    order = np.lexsort((xs, ys, -vals))
+    cell_w, cell_h = half_x + 1, half_y + 1
+    grid = {}
+    wells_loc = []
+    for i in order:
+        if vals[i] < match_thre:
+            break
+        x, y = int(xs[i]), int(ys[i])
+        gx, gy = x // cell_w, y // cell_h
+        blocked = any(
+            abs(ax - x) <= half_x and abs(ay - y) <= half_y
+            for nx in (gx - 1, gx, gx + 1)
+            for ny in (gy - 1, gy, gy + 1)
+            for ax, ay in grid.get((nx, ny), ())
+        )
+        if not blocked:
+            grid.setdefault((gx, gy), []).append((x, y))
+            wells_loc.append((x, y))
+    return wells_loc
+
+
+def pyramidPeaks(img_binary, t, match_thre, levels=None, coarse_thre=None):
+    """
+    Coarse-to-fine well matching.
+
+    Matches a downscaled template on a downscaled image, keeps the coarse
+    peaks above coarse_thre (2 * match_thre by default, weaker coarse hits
+    are mostly binarization noise), then recomputes the full resolution
+    response only in a small window around each of them.
+    """
+    if levels is None:
+        levels = pyramidLevels(t.shape)
+    if levels == 0:
+        result = cv2.matchTemplate(img_binary, t, cv2.TM_CCOEFF_NORMED)
+        return findPeaks(result, t.shape, match_thre)
+    if coarse_thre is None:
+        coarse_thre = 2 * match_thre
+
+    scale = 2**levels
+    small_img = cv2.resize(
+        img_binary, None, fx=1 / scale, fy=1 / scale, interpolation=cv2.INTER_AREA
+    )
+    small_t = cv2.resize(
+        t, None, fx=1 / scale, fy=1 / scale, interpolation=cv2.INTER_AREA
+    )
+    coarse = cv2.matchTemplate(small_img, small_t, cv2.TM_CCOEFF_NORMED)
+    half_shape = (small_t.shape[0] // 2, small_t.shape[1] // 2)
+    coarse_loc = findPeaks(coarse, half_shape, coarse_thre)
+
+    t_h, t_w = t.shape
+    res_h = img_binary.shape[0] - t_h + 1
+    res_w = img_binary.shape[1] - t_w + 1
+    radius = scale + 1
+    xs, ys, vals = [], [], []
+    for cx, cy in coarse_loc:
+        cx, cy = cx * scale, cy * scale
+        x0, x1 = max(cx - radius, 0), min(cx + radius, res_w - 1)
+        y0, y1 = max(cy - radius, 0), min(cy + radius, res_h - 1)
+        patch = img_binary[y0 : y1 + t_h, x0 : x1 + t_w]
+        res = cv2.matchTemplate(patch, t, cv2.TM_CCOEFF_NORMED)
+        _, max_val, _, max_loc = cv2.minMaxLoc(res)
+        xs.append(x0 + max_loc[0])
+        ys.append(y0 + max_loc[1])
+        vals.append(max_val)
+
+    return suppressPoints(
+        np.array(xs), np.array(ys), np.array(vals), t.shape, match_thre
+    )
+
+
+def _cross(a, b):
+    return a[..., 0] * b[..., 1] - a[..., 1] * b[..., 0]
+
+
+def _densestDirection(vecs, max_angle=15.0):
+    """Median of the largest group of vectors pointing the same way."""
+    unit = vecs / np.linalg.norm(vecs, axis=1, keepdims=True)
+    close = np.abs(unit @ unit.T) >= np.cos(np.radians(max_angle))
+    group = close[np.argmax(close.sum(axis=1))]
+    # flip the group to one side before taking the median
+    ref = vecs[group][0]
+    members = vecs[group] * np.sign(vecs[group] @ ref)[:, None]
+    return np.median(members, axis=0)
+
+
+def estimateLattice(points):
+    """
+    Estimate the basis vectors of a regular grid from some of its points.
+
+    Returns (a, b), a being the column step (pointing right) and b the row
+    step (pointing down), or None if the points do not span a lattice.
+    """
+    if len(points) < 4:
+        return None
+    diff = points[None, :, :] - points[:, None, :]
+    dist = np.linalg.norm(diff, axis=2)
+    np.fill_diagonal(dist, np.inf)
+    pitch = np.median(dist.min(axis=1))
+    if not np.isfinite(pitch) or pitch < 1:
+        return None
+
+    # the most common nearest-neighbour direction is one basis vector
+    vecs = diff[dist < 1.3 * pitch]
+    a = _densestDirection(vecs)
+
+    # the shortest steps that are not along a give the other one
+    vecs = diff[np.isfinite(dist) & (dist < 4 * pitch)]
+    lengths = np.linalg.norm(vecs, axis=1)
+    sin = np.abs(_cross(a, vecs)) / (np.linalg.norm(a) * lengths)
+    vecs, lengths = vecs[sin > 0.5], lengths[sin > 0.5]
+    if len(vecs) == 0:
+        return None
+    b = _densestDirection(vecs[lengths < 1.3 * lengths.min()])
+
+    if abs(a[0]) < abs(b[0]):
+        a, b = b, a
+    a = a if a[0] >= 0 else -a
+    b = b if b[1] >= 0 else -b
+    if abs(_cross(a, b)) < 0.25 * np.linalg.norm(a) * np.linalg.norm(b):
+        return None
+    return a, b
+
+
+def fitLattice(points, idx):
+    """Least squares origin and basis (rotation and shear allowed)."""
+    A = np.column_stack([np.ones(len(idx)), idx])
+    sol, *_ = np.linalg.lstsq(A, points, rcond=None)
+    return sol[0], sol[1], sol[2]
+
+
+def latticeIndex(points, origin, a, b):
+    coef = np.linalg.solve(np.stack([a, b], axis=1), (points - origin).T).T
+    idx = np.round(coef)
+    resid = np.linalg.norm(points - origin - idx @ np.stack([a, b]), axis=1)
+    return idx.astype(np.int64), resid
+
+
+def latticePeaks(img_binary, t, match_thre, seed_thre=0.5, min_seeds=12):
+    """
+    Grid extraction for regular microwell chips.
+
+    Detects high-confidence wells in a central crop, fits the lattice to
+    them, then predicts the wells of a region that doubles in size each
+    round. Only the predicted positions are verified, each against the
+    response of a small patch, and the lattice is refitted on the confident
+    wells after every round. The chip spans the rows and columns of the
+    confident wells, weaker hits outside them are dropped. Returns
+    (x, y, row, col) tuples, row-major.
+    """
+    t_h, t_w = t.shape
+    res_h = img_binary.shape[0] - t_h + 1
+    res_w = img_binary.shape[1] - t_w + 1
+    center = np.array([res_w / 2, res_h / 2])
+
+    # 1. seeds from a central crop, grown until there are enough of them
+    half = 8 * max(t.shape)
+    while True:
+        x0, y0 = (np.maximum(center - half, 0)).astype(int)
+        x1, y1 = int(min(center[0] + half, res_w)), int(min(center[1] + half, res_h))
+        crop = img_binary[y0 : y1 + t_h - 1, x0 : x1 + t_w - 1]
+        res = cv2.matchTemplate(crop, t, cv2.TM_CCOEFF_NORMED)
+        seeds = np.array(findPeaks(res, t.shape, seed_thre), dtype=np.float64)
+        seeds = seeds.reshape(-1, 2) + (x0, y0)
+        if len(seeds) >= min_seeds or (x0 == 0 and y0 == 0 and x1 == res_w and y1 == res_h):
+            break
+        half *= 2
+
+    lattice = estimateLattice(seeds)
+    if lattice is None:
+        return None
+    a, b = lattice
+    origin = seeds[np.argmin(np.linalg.norm(seeds - center, axis=1))]
+    for _ in range(2):
+        idx, resid = latticeIndex(seeds, origin, a, b)
+        inliers = resid < 0.25 * min(np.linalg.norm(a), np.linalg.norm(b))
+        if inliers.sum() < 4:
+            return None
+        origin, a, b = fitLattice(seeds[inliers], idx[inliers])
+
+    # 2. predict and verify, growing the region each round
+    radius = max(2, int(0.2 * min(np.linalg.norm(a), np.linalg.norm(b))))
+    verified = {}
+    tried = set()
+    while True:
+        lo = np.maximum(center - half, 0)
+        hi = np.minimum(center + half, (res_w - 1, res_h - 1))
+        corners = np.array([[lo[0], lo[1]], [hi[0], lo[1]], [lo[0], hi[1]], [hi[0], hi[1]]])
+        coef = np.linalg.solve(np.stack([a, b], axis=1), (corners - origin).T)
+        i_range = np.arange(np.floor(coef[0].min()), np.ceil(coef[0].max()) + 1)
+        j_range = np.arange(np.floor(coef[1].min()), np.ceil(coef[1].max()) + 1)
+        ii, jj = np.meshgrid(i_range, j_range)
+        ii, jj = ii.ravel().astype(np.int64), jj.ravel().astype(np.int64)
+        pos = origin + ii[:, None] * a + jj[:, None] * b
+        inside = np.all((pos >= lo) & (pos <= hi), axis=1)
+
+        for i, j, (px, py) in zip(ii[inside], jj[inside], np.rint(pos[inside]).astype(int)):
+            if (i, j) in tried:
+                continue
+            tried.add((i, j))
+            px0, px1 = max(px - radius, 0), min(px + radius, res_w - 1)
+            py0, py1 = max(py - radius, 0), min(py + radius, res_h - 1)
+            if px0 > px1 or py0 > py1:
+                continue
+            patch = img_binary[py0 : py1 + t_h, px0 : px1 + t_w]
+            res = cv2.matchTemplate(patch, t, cv2.TM_CCOEFF_NORMED)
+            _, max_val, _, max_loc = cv2.minMaxLoc(res)
+            if max_val >= match_thre:
+                verified[(i, j)] = (int(px0 + max_loc[0]), int(py0 + max_loc[1]), max_val)
+
+        # weak hits on the margins can be noise, the fit only uses confident wells
+        confident = [key for key, (_, _, val) in verified.items() if val >= seed_thre]
+        if len(confident) >= 4:
+            idx = np.array(confident, dtype=np.float64)
+            points = np.array([verified[key][:2] for key in confident], dtype=np.float64)
+            origin, a, b = fitLattice(points, idx)
+        if np.all(lo == 0) and np.all(hi == (res_w - 1, res_h - 1)):
+            break
+        half *= 2
+
+    # 3. the chip is the index range of the confident wells, so margin noise
+    # neither adds rows and columns nor moves row and column 0
+    if not verified:
+        return []
+    confident = [key for key, (_, _, val) in verified.items() if val >= seed_thre]
+    keys = np.array(confident or list(verified.keys()))
+    (i_min, j_min), (i_max, j_max) = keys.min(axis=0), keys.max(axis=0)
+    wells_loc = [
+        (x, y, int(j - j_min), int(i - i_min))
+        for (i, j), (x, y, _) in verified.items()
+        if i_min <= i <= i_max and j_min <= j <= j_max
+    ]
+    wells_loc.sort(key=lambda loc: (loc[2], loc[3]))
+    return wells_loc
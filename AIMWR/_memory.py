@@ -0,0 +1,26 @@
+import os
+import sys
+
+
+def peakRssMb():
+    """Peak resident memory of this process in MB."""
+    # VmHWM restarts at exec, unlike ru_maxrss which keeps the parent's peak
+    if os.path.exists("/proc/self/status"):
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) / 1024
+    import resource
+
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss / 1024 / 1024 if sys.platform == "darwin" else rss / 1024
+
+
+def resetPeakRss():
+    """Restart the peak at the current RSS, where the kernel allows it."""
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+        return True
+    except OSError:
+        return False
@@ -1,13 +1,19 @@
+import math
+import cv2
 import torch
+import numpy as np
 from torchvision import models
 from torch.utils.data import Dataset
 from torch import nn
+from torch.nn import functional as F
 from torchvision import transforms
 
 
 class MobileNet(nn.Module):
     """MobileNetV3(small)"""
 
+    HEAD = "net.classifier"
+
     def __init__(self, num_classes):
         super().__init__()
         self.net = models.mobilenet_v3_small()
@@ -21,6 +27,8 @@ class MobileNet(nn.Module):
 class Resnet18(nn.Module):
     """Resnet18"""
 
+    HEAD = "net.fc"
+
     def __init__(self, num_classes):
         super().__init__()
         self.net = models.resnet18()
@@ -34,6 +42,8 @@ class Resnet18(nn.Module):
 class Resnet50(nn.Module):
     """Resnet50"""
 
+    HEAD = "net.fc"
+
     def __init__(self, num_classes):
         super().__init__()
         self.net = models.resnet50()
@@ -44,30 +54,244 @@ class Resnet50(nn.Module):
         return x
 
 
-class WellDataset(Dataset):
-    def __init__(self, well_imgs, class_idxs):
-        self.well_imgs = well_imgs
-        self.class_idxs = class_idxs
-
-        self.transforms = transforms.Compose(
-            [
-                # transforms.Grayscale(num_output_channels=1),
-                transforms.ToTensor(),
-                transforms.Resize([32, 32]),
-                transforms.Normalize((0.5, 0.5, 0.5), (0.5, 0.5, 0.5)),
-                transforms.RandomHorizontalFlip(),
-                transforms.RandomVerticalFlip(),
-                transforms.RandomRotation(180),
-                transforms.RandomAffine(0, shear=10, scale=(0.8, 1.2)),
-            ]
+class WellNet(nn.Module):
+    """
+    A small CNN for 32x32 wells: a 3x3 conv at 32 pixels, then stages of
+    3x3 convs at 16 and 8 pixels, global average pooling and a linear head.
+    The ImageNet backbones shrink a well to 1x1 in their first stages.
+    """
+
+    HEAD = "classifier"
+    WIDTHS = (32, 64, 128)
+    DEPTH = 1
+
+    def __init__(self, num_classes):
+        super().__init__()
+        layers = self.conv(3, self.WIDTHS[0], 1)
+        # depth goes to the smaller stages, a conv there is 4 and 16 times cheaper
+        for in_channels, width in zip(self.WIDTHS, self.WIDTHS[1:]):
+            layers += self.conv(in_channels, width, 2)
+            for _ in range(self.DEPTH - 1):
+                layers += self.conv(width, width, 1)
+        self.features = nn.Sequential(*layers)
+        self.pool = nn.AdaptiveAvgPool2d(1)
+        self.classifier = nn.Linear(self.WIDTHS[-1], num_classes)
+
+    @staticmethod
+    def conv(in_channels, out_channels, stride):
+        return [
+            nn.Conv2d(in_channels, out_channels, 3, stride, 1, bias=False),
+            nn.BatchNorm2d(out_channels),
+            nn.ReLU(inplace=True),
+        ]
+
+    def forward(self, x):
+        x = self.pool(self.features(x)).flatten(1)
+        x = self.classifier(x)
+        return x
+
+
+class WellNetS(WellNet):
+    """WellNet, 16-32-64 channels, one conv per stage"""
+
+    WIDTHS = (16, 32, 64)
+    DEPTH = 1
+
+
+class WellNetM(WellNet):
+    """WellNet, 32-64-128 channels, one conv per stage"""
+
+    WIDTHS = (32, 64, 128)
+    DEPTH = 1
+
+
+class WellNetL(WellNet):
+    """WellNet, 32-64-128 channels, two convs per smaller stage"""
+
+    WIDTHS = (32, 64, 128)
+    DEPTH = 2
+
+
+# model types by the names used in model file names, without "_"
+MODELS = {
+    "MobileNet": MobileNet,
+    "Resnet18": Resnet18,
+    "Resnet50": Resnet50,
+    "WellNetS": WellNetS,
+    "WellNetM": WellNetM,
+    "WellNetL": WellNetL,
+}
+HEADS = ["linear", "mlp"]
+
+
+def getHead(model):
+    return model.get_submodule(model.HEAD)
+
+
+def setHead(model, head):
+    parent_name, _, name = model.HEAD.rpartition(".")
+    setattr(model.get_submodule(parent_name), name, head)
+
+
+def headKind(model):
+    return "mlp" if isinstance(getHead(model), nn.Sequential) else "linear"
+
+
+def headFeatures(model):
+    """Size of the penultimate-layer features, the input of the head."""
+    return next(m for m in getHead(model).modules() if isinstance(m, nn.Linear)).in_features
+
+
+def makeHead(kind, in_features, num_classes, hidden=256):
+    if kind == "mlp":
+        return nn.Sequential(
+            nn.Linear(in_features, hidden), nn.ReLU(), nn.Linear(hidden, num_classes)
         )
+    return nn.Linear(in_features, num_classes)
+
+
+class WellDataset(Dataset):
+    """
+    Wells resized once and packed into a uint8 N x 3 x 32 x 32 tensor, only
+    the random augmentations run per sample. With augment=False they are left
+    to BatchAugment on whole batches.
+    """
+
+    SIZE = 32
+
+    def __init__(self, well_imgs, class_idxs, augment=True):
+        self.wells = torch.from_numpy(packWells(well_imgs, self.SIZE)).permute(0, 3, 1, 2)
+        self.wells = self.wells.contiguous()
+        self.class_idxs = torch.as_tensor(class_idxs, dtype=torch.int64)
+        self.transforms = wellTransforms(augment)
 
     def __len__(self):
-        print("len(self.class_idxs):", len(self.class_idxs))
         return len(self.class_idxs)
 
     def __getitem__(self, idx):
-        img = self.well_imgs[idx] / 255.0
+        img = self.wells[idx].float() / 255.0
         img = self.transforms(img)
-        label = self.class_idxs[idx]
-        return img.to(torch.float32), torch.tensor(label).to(torch.float32)
+        return img, self.class_idxs[idx]
+
+    def shareMemory(self):
+        # loader workers then map the same tensors instead of copying them
+        self.wells.share_memory_()
+        self.class_idxs.share_memory_()
+
+
+class DiskWellDataset(WellDataset):
+    """
+    WellDataset over rows of a uint8 N x 32 x 32 x 3 file, read on access,
+    for workspaces whose wells do not fit in memory.
+    """
+
+    def __init__(self, wells_path, num_rows, rows, class_idxs, augment=True):
+        self.wells_path = wells_path
+        self.num_rows = num_rows
+        self.rows = np.asarray(rows, dtype=np.int64)
+        self.class_idxs = torch.as_tensor(class_idxs, dtype=torch.int64)
+        self.transforms = wellTransforms(augment)
+        self.wells = None
+
+    def shareMemory(self):
+        # the file is mapped, workers share it through the page cache
+        self.class_idxs.share_memory_()
+
+    def __getstate__(self):
+        # every loader worker maps the file itself
+        state = self.__dict__.copy()
+        state["wells"] = None
+        return state
+
+    def __getitem__(self, idx):
+        if self.wells is None:
+            self.wells = np.memmap(
+                self.wells_path,
+                dtype=np.uint8,
+                mode="r",
+                shape=(self.num_rows, self.SIZE, self.SIZE, 3),
+            )
+        well = torch.from_numpy(np.array(self.wells[self.rows[idx]])).permute(2, 0, 1)
+        img = self.transforms(well.float() / 255.0)
+        return img, self.class_idxs[idx]
+
+
+def wellTransforms(augment=True):
+    augmentations = [
+        transforms.RandomHorizontalFlip(),
+        transforms.RandomVerticalFlip(),
+        transforms.RandomRotation(180),
+        transforms.RandomAffine(0, shear=10, scale=(0.8, 1.2)),
+    ]
+    return transforms.Compose(
+        [
+            # transforms.Grayscale(num_output_channels=1),
+            transforms.Normalize((0.5, 0.5, 0.5), (0.5, 0.5, 0.5)),
+        ]
+        + (augmentations if augment else [])
+    )
+
+
+class BatchAugment(nn.Module):
+    """
+    The flips, rotation, shear and scale of WellDataset for a whole batch.
+
+    Each sample gets the same random draws as the per-sample transforms, but
+    they are composed into one affine matrix, so the batch is warped by a
+    single grid_sample on its own device. Like the transforms, it samples the
+    nearest pixel and fills with 0.
+    """
+
+    def __init__(self, degrees=180, shear=10, scale=(0.8, 1.2), mode="nearest"):
+        super().__init__()
+        self.degrees = degrees
+        self.shear = shear
+        self.scale = scale
+        self.mode = mode
+
+    def forward(self, x):
+        n = x.shape[0]
+
+        def uniform(low, high):
+            return torch.empty(n, device=x.device).uniform_(low, high)
+
+        def flip():
+            return torch.where(torch.rand(n, device=x.device) < 0.5, -1.0, 1.0)
+
+        flip_x, flip_y = flip(), flip()
+        angle = uniform(-self.degrees, self.degrees) * (math.pi / 180)
+        tan = torch.tan(uniform(-self.shear, self.shear) * (math.pi / 180))
+        scale = uniform(*self.scale)
+        cos, sin = torch.cos(angle), torch.sin(angle)
+
+        # points move by flip, rotation, then shear and scale: p' = A R F p,
+        # grid_sample wants where each output pixel comes from, F R^-1 A^-1
+        theta = torch.zeros(n, 2, 3, device=x.device)
+        theta[:, 0, 0] = flip_x * cos / scale
+        theta[:, 0, 1] = flip_x * (cos * tan + sin) / scale
+        theta[:, 1, 0] = -flip_y * sin / scale
+        theta[:, 1, 1] = flip_y * (cos - sin * tan) / scale
+        grid = F.affine_grid(theta, list(x.shape), align_corners=False)
+        out = F.grid_sample(
+            x, grid, mode=self.mode, padding_mode="zeros", align_corners=False
+        )
+
+        # the transforms fill what the rotation moves out of frame before the
+        # shear and scale, drop the pixels that came from there
+        theta_a = torch.zeros(n, 2, 3, device=x.device)
+        theta_a[:, 0, 0] = 1 / scale
+        theta_a[:, 0, 1] = tan / scale
+        theta_a[:, 1, 1] = 1 / scale
+        inner = F.affine_grid(theta_a, list(x.shape), align_corners=False)
+        inside = ((inner >= -1) & (inner < 1)).all(-1)
+        return out * inside.unsqueeze(1)
+
+
+def packWells(well_imgs, size=32):
+    """Well images of any size to one contiguous uint8 N x size x size x 3 array."""
+    if isinstance(well_imgs, np.ndarray) and well_imgs.shape[1:] == (size, size, 3):
+        return np.ascontiguousarray(well_imgs, dtype=np.uint8)
+    wells = np.empty((len(well_imgs), size, size, 3), dtype=np.uint8)
+    for i, well_img in enumerate(well_imgs):
+        cv2.resize(well_img, (size, size), dst=wells[i])
+    return wells
@@ -0,0 +1,149 @@
+import os
+import copy
+import json
+import time
+import zipfile
+import warnings
+
+import numpy as np
+import torch
+from torch import nn
+
+CPU_MODES = ["fp32", "traced", "int8_dynamic", "int8_static"]
+
+
+def artifactPath(model_path, mode):
+    """The optimized model is saved next to its .pth, one file per mode."""
+    root, _ = os.path.splitext(model_path)
+    return f"{root}.{mode}.pt"
+
+
+def reportPath(model_path, mode):
+    root, _ = os.path.splitext(model_path)
+    return f"{root}.{mode}.json"
+
+
+def sourceStamp(model_path):
+    stat = os.stat(model_path)
+    return {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns}
+
+
+def isFresh(model_path, mode):
+    # the artifact records the .pth it was built from, read without loading it
+    path = artifactPath(model_path, mode)
+    if not os.path.exists(path):
+        return False
+    try:
+        with zipfile.ZipFile(path) as archive:
+            name = next(n for n in archive.namelist() if n.endswith("extra/source.json"))
+            return json.loads(archive.read(name)) == sourceStamp(model_path)
+    except (zipfile.BadZipFile, StopIteration, ValueError):
+        return False
+
+
+def convertModel(model, mode, calib_batches=()):
+    """
+    A frozen TorchScript graph of model, in channels_last layout.
+
+    int8_dynamic quantizes the linear layers, int8_static also the
+    convolutions, with activation ranges observed on calib_batches.
+    """
+    model = copy.deepcopy(model).cpu().eval()
+    example = torch.zeros(2, 3, 32, 32).contiguous(memory_format=torch.channels_last)
+
+    # torch.ao quantization warns that it moves to torchao, it still gives
+    # a CPU graph that TorchScript can save
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore")
+        if mode == "int8_dynamic":
+            from torch.ao.quantization import quantize_dynamic
+
+            model = quantize_dynamic(model, {nn.Linear}, dtype=torch.qint8)
+        elif mode == "int8_static":
+            from torch.ao.quantization import get_default_qconfig_mapping
+            from torch.ao.quantization.quantize_fx import prepare_fx, convert_fx
+
+            qconfig_mapping = get_default_qconfig_mapping("x86")
+            model = prepare_fx(model, qconfig_mapping, (example,))
+            with torch.no_grad():
+                for batch in calib_batches:
+                    model(batch)
+            model = convert_fx(model)
+        elif mode != "traced":
+            raise ValueError(f"Invalid CPU mode: {mode}")
+
+        model = model.to(memory_format=torch.channels_last)
+        with torch.no_grad():
+            traced = torch.jit.freeze(torch.jit.trace(model, example))
+    return traced
+
+
+def predictAll(model, wells_tensor, batch_size=256):
+    """Predicted classes and seconds per well."""
+    predicted = []
+    start = time.perf_counter()
+    with torch.no_grad():
+        for i in range(0, len(wells_tensor), batch_size):
+            output = model(wells_tensor[i : i + batch_size])
+            predicted.append(output.argmax(1))
+    elapsed = time.perf_counter() - start
+    return torch.cat(predicted).numpy(), elapsed / max(len(wells_tensor), 1)
+
+
+def compareModels(ref_model, model, wells_tensor, labels):
+    """Accuracy and speed of model against the fp32 ref_model on labelled wells."""
+    # warm up, the first calls of a frozen graph run the JIT optimizer
+    predictAll(model, wells_tensor[:64])
+    predictAll(ref_model, wells_tensor[:64])
+    ref_predicted, ref_time = predictAll(ref_model, wells_tensor)
+    predicted, opt_time = predictAll(model, wells_tensor)
+    labels = np.asarray(labels)
+    return {
+        "wells": len(labels),
+        "fp32_accuracy": float((ref_predicted == labels).mean()),
+        "accuracy": float((predicted == labels).mean()),
+        "agreement": float((ref_predicted == predicted).mean()),
+        "fp32_ms_per_1k": ref_time * 1e6,
+        "ms_per_1k": opt_time * 1e6,
+    }
+
+
+def reportText(mode, report):
+    if not report or not report.get("wells"):
+        return f"CPU mode {mode}: no edited wells to compare with fp32."
+    delta = (report["accuracy"] - report["fp32_accuracy"]) * 100
+    speedup = report["fp32_ms_per_1k"] / max(report["ms_per_1k"], 1e-9)
+    return (
+        f"CPU mode {mode}: accuracy {report['accuracy'] * 100:.2f}% "
+        f"({delta:+.2f} vs fp32), agreement {report['agreement'] * 100:.2f}%, "
+        f"{speedup:.1f}x fp32 speed on {report['wells']} edited wells."
+    )
+
+
+def buildOptimized(model_path, mode, fp32_model, wells_tensor, labels):
+    """Convert, compare with fp32 and save the artifact and its report."""
+    calib_batches = wells_tensor.split(64) if len(wells_tensor) else ()
+    if mode == "int8_static" and not len(wells_tensor):
+        raise ValueError("Static quantization needs edited wells to calibrate.")
+    optimized = convertModel(fp32_model, mode, calib_batches)
+
+    report = {}
+    if len(wells_tensor):
+        report = compareModels(fp32_model, optimized, wells_tensor, labels)
+
+    # written to a temporary file first, a half-written artifact is never loaded
+    path = artifactPath(model_path, mode)
+    extra_files = {"source.json": json.dumps(sourceStamp(model_path))}
+    torch.jit.save(optimized, path + ".tmp", _extra_files=extra_files)
+    os.replace(path + ".tmp", path)
+    with open(reportPath(model_path, mode), "w") as f:
+        json.dump(report, f, indent=4)
+    return report
+
+
+def loadReport(model_path, mode):
+    path = reportPath(model_path, mode)
+    if not os.path.exists(path):
+        return {}
+    with open(path, "r") as f:
+        return json.load(f)
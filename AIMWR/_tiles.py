@@ -0,0 +1,122 @@
+import cv2
+import numpy as np
+
+from ._matching import findPeaks
+
+# rough bytes per pixel of a tile while it is binarized, matched and searched
+TILE_BYTES_PER_PIXEL = 40
+
+
+class GrayImage:
+    """
+    Grayscale rows of an image, read tile by tile.
+
+    Uncompressed 24/32-bit BMP files are memory-mapped, so a tile only
+    touches its own rows. Other formats are decoded once, and only the gray
+    image is kept.
+    """
+
+    def __init__(self, path, data=None, src_color=None):
+        self.gray = None
+        self.rows = None
+        if src_color is not None or not self._mapBmp(path):
+            if src_color is None:
+                if data is None:
+                    data = np.fromfile(path, dtype=np.uint8)
+                src_color = cv2.imdecode(data, cv2.IMREAD_COLOR)
+            self.gray = cv2.cvtColor(src_color, cv2.COLOR_BGR2GRAY)
+            self.shape = self.gray.shape
+
+    def _mapBmp(self, path):
+        if not path.lower().endswith(".bmp"):
+            return False
+        header = np.fromfile(path, dtype=np.uint8, count=54)
+        if len(header) < 54 or header[:2].tobytes() != b"BM":
+            return False
+        offset = int(header[10:14].view("<u4")[0])
+        width = int(header[18:22].view("<i4")[0])
+        height = int(header[22:26].view("<i4")[0])
+        bit_count = int(header[28:30].view("<u2")[0])
+        compression = int(header[30:34].view("<u4")[0])
+        if bit_count not in (24, 32) or compression != 0 or width <= 0:
+            return False
+
+        channels = bit_count // 8
+        stride = (width * channels + 3) & ~3
+        self.rows = np.memmap(
+            path, dtype=np.uint8, mode="r", offset=offset, shape=(abs(height), stride)
+        )
+        self.channels = channels
+        self.bottom_up = height > 0
+        self.shape = (abs(height), width)
+        return True
+
+    def read(self, y0, y1, x0, x1):
+        if self.gray is not None:
+            return self.gray[y0:y1, x0:x1]
+
+        h = self.shape[0]
+        if self.bottom_up:
+            rows = self.rows[h - y1 : h - y0][::-1]
+        else:
+            rows = self.rows[y0:y1]
+        pixels = rows[:, x0 * self.channels : x1 * self.channels]
+        pixels = np.ascontiguousarray(pixels).reshape(y1 - y0, x1 - x0, self.channels)
+        code = cv2.COLOR_BGR2GRAY if self.channels == 3 else cv2.COLOR_BGRA2GRAY
+        return cv2.cvtColor(pixels, code)
+
+
+def tileSize(memory_mb, halo):
+    """Side of the tile core that fits memory_mb with its halo."""
+    side = int((memory_mb * 1024 * 1024 / TILE_BYTES_PER_PIXEL) ** 0.5)
+    return max(side - 2 * halo, halo)
+
+
+def tiledPeaks(image, t, match_thre, block_size, block_c, memory_mb):
+    """
+    Exhaustive well matching over overlapping tiles of a GrayImage.
+
+    Each tile covers a core of the response map plus a halo of four
+    suppression boxes, so the suppression around the core sees the same
+    neighbours as on the whole image. Only the peaks inside the core are
+    kept, which merges the tiles without duplicates.
+    """
+    t_h, t_w = t.shape
+    img_h, img_w = image.shape
+    res_h, res_w = img_h - t_h + 1, img_w - t_w + 1
+    halo = 4 * max(t_h, t_w)
+    pad = block_size // 2
+    side = tileSize(memory_mb, halo)
+
+    xs, ys, vals = [], [], []
+    for ry0 in range(0, res_h, side):
+        for rx0 in range(0, res_w, side):
+            ry1, rx1 = min(ry0 + side, res_h), min(rx0 + side, res_w)
+
+            # response window with halo, its binary and gray windows
+            wy0, wx0 = max(ry0 - halo, 0), max(rx0 - halo, 0)
+            wy1, wx1 = min(ry1 + halo, res_h), min(rx1 + halo, res_w)
+            by1, bx1 = wy1 + t_h - 1, wx1 + t_w - 1
+            gy0, gx0 = max(wy0 - pad, 0), max(wx0 - pad, 0)
+            gy1, gx1 = min(by1 + pad, img_h), min(bx1 + pad, img_w)
+
+            gray = image.read(gy0, gy1, gx0, gx1)
+            img_binary = cv2.adaptiveThreshold(
+                gray, 255, cv2.ADAPTIVE_THRESH_MEAN_C, cv2.THRESH_BINARY, block_size, block_c
+            )
+            img_binary = img_binary[wy0 - gy0 : by1 - gy0, wx0 - gx0 : bx1 - gx0]
+            result = cv2.matchTemplate(img_binary, t, cv2.TM_CCOEFF_NORMED)
+            del gray, img_binary
+
+            wells_loc, values = findPeaks(result, t.shape, match_thre, return_values=True)
+            for (x, y), val in zip(wells_loc, values):
+                x, y = x + wx0, y + wy0
+                if rx0 <= x < rx1 and ry0 <= y < ry1:
+                    xs.append(x)
+                    ys.append(y)
+                    vals.append(val)
+
+    # same ordering as findPeaks on the whole map
+    xs, ys, vals = np.array(xs), np.array(ys), np.array(vals, dtype=np.float32)
+    order = np.lexsort((xs, ys, -vals))
+    return [(int(xs[i]), int(ys[i])) for i in order]
@@ -0,0 +1,150 @@
+import os
+import time
+import socket
+from datetime import timedelta
+
+import torch
+import torch.distributed as dist
+from torch.nn.parallel import DistributedDataParallel
+from torch.utils.data.distributed import DistributedSampler
+
+from ._nets import BatchAugment
+from ._inference import autocast
+from ._checkpoint import buildModel
+
+# no PySide6 here, so data-parallel ranks only load torch
+# longest wait for all ranks to join, start-up includes importing torch
+INIT_TIMEOUT = 120
+
+
+def trainEpoch(
+    model,
+    dataloader,
+    optimizer,
+    scaler,
+    augment,
+    device,
+    precision,
+    non_blocking=False,
+    should_stop=None,
+    progress=None,
+    distributed=False,
+):
+    """
+    One pass over dataloader, returns the seconds spent waiting for batches
+    and in training steps, and whether should_stop cut it short.
+
+    With distributed, the ranks of the default process group agree on
+    stopping before every step, so that no rank is left waiting in the
+    gradient all-reduce.
+    """
+    criterion = torch.nn.CrossEntropyLoss()
+    data_s, compute_s = 0.0, 0.0
+    stopped = False
+    tic = time.perf_counter()
+    for i, (inputs, labels) in enumerate(dataloader):
+        stopped = should_stop is not None and should_stop()
+        if distributed:
+            flag = torch.tensor([int(stopped)])
+            dist.all_reduce(flag, op=dist.ReduceOp.MAX)
+            stopped = bool(flag.item())
+        if stopped:
+            break
+        loaded = time.perf_counter()
+        data_s += loaded - tic
+        inputs = inputs.to(device, non_blocking=non_blocking)
+        labels = labels.to(device, non_blocking=non_blocking)
+        if augment is not None:
+            inputs = augment(inputs)
+
+        optimizer.zero_grad()
+        with autocast(device, precision):
+            outputs = model(inputs)
+            loss = criterion(outputs, labels)
+        scaler.scale(loss).backward()
+        scaler.step(optimizer)
+        scaler.update()
+        loss_value = loss.item()  # waits for the device
+
+        if progress is not None and i % 10 == 0:
+            progress(i + 1, loss_value)
+        tic = time.perf_counter()
+        compute_s += tic - loaded
+    return data_s, compute_s, stopped
+
+
+def freePort():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def rankStore(port, world_size, rank):
+    """The TCP store of the ranks, served by rank 0, which does not wait here."""
+    return dist.TCPStore(
+        "127.0.0.1",
+        port,
+        world_size,
+        is_master=rank == 0,
+        timeout=timedelta(seconds=INIT_TIMEOUT),
+        wait_for_workers=False,
+    )
+
+
+def joinGroup(store, rank, world_size):
+    dist.init_process_group(
+        "gloo",
+        store=store,
+        rank=rank,
+        world_size=world_size,
+        timeout=timedelta(seconds=INIT_TIMEOUT),
+    )
+
+
+def trainRank(rank, world_size, port, cores, model_state, config, dataset):
+    # a data-parallel rank besides the TrainThread, which is rank 0 and the
+    # only one to validate and save
+    if hasattr(os, "sched_setaffinity"):
+        os.sched_setaffinity(0, cores)
+    torch.set_num_threads(len(cores))
+    torch.manual_seed(rank)
+    store = rankStore(port, world_size, rank)
+    # rank 0 counts the joined ranks, so it can stop waiting for a dead one
+    store.add("joined", 1)
+    joinGroup(store, rank, world_size)
+    try:
+        device = torch.device("cpu")
+        model = buildModel(model_state)
+        model.train()
+        optimizer = torch.optim.Adam(model.parameters(), lr=0.001)
+        scaler = torch.amp.GradScaler("cpu", enabled=False)
+        if config["resume_path"]:
+            checkpoint = torch.load(config["resume_path"], weights_only=False)
+            optimizer.load_state_dict(checkpoint["optimizer"])
+        model = DistributedDataParallel(model)
+        sampler = DistributedSampler(dataset, world_size, rank, seed=0)
+        dataloader = torch.utils.data.DataLoader(
+            dataset, batch_size=config["batch_size"], sampler=sampler
+        )
+        augment = BatchAugment() if config["batch_augment"] else None
+
+        early_stop = torch.zeros(1)
+        for epoch in range(config["start_epoch"], config["max_epoch"]):
+            sampler.set_epoch(epoch)
+            _, _, stopped = trainEpoch(
+                model,
+                dataloader,
+                optimizer,
+                scaler,
+                augment,
+                device,
+                config["precision"],
+                distributed=True,
+            )
+            if stopped:
+                break
+            dist.broadcast(early_stop, 0)
+            if early_stop.item():
+                break
+    finally:
+        dist.destroy_process_group()
@@ -1,73 +1,181 @@
 import os
 import cv2
+import copy
+import math
 import time
 import torch
+import torch.distributed as dist
+import multiprocessing
+from collections import deque
+from queue import Empty
+from concurrent.futures import ProcessPoolExecutor, Future, FIRST_COMPLETED, wait
 import numpy as np
-from torchvision import transforms
+from torch.nn.parallel import DistributedDataParallel
+from torch.utils.data.distributed import DistributedSampler
 from PySide6.QtCore import QThread, Signal
 
-from ._nets import MobileNet, Resnet18, Resnet50, WellDataset
+from ._nets import MODELS, WellDataset, DiskWellDataset, BatchAugment, makeHead, setHead
+from ._cache import fileFingerprint
+from ._extraction import Extractor, MAX_WORKERS, extractImage, initExtractWorker, extractWorker
+from ._inference import WellBatcher, autoBatchSize, loadModel, autocast
+from ._inference import normalizeWells, classifyBatch, classifyShard
+from ._crops import cropWells, loadCrops, readWellsLoc, readEdit, WellStore
+from ._optimize import artifactPath, isFresh, buildOptimized, loadReport
+from ._memory import peakRssMb, resetPeakRss
+from ._checkpoint import CheckpointWriter, cpuCopy, modelState, buildModel, readModel
+from ._features import FeatureCache, embed
+from ._training import trainEpoch, trainRank, freePort, rankStore, joinGroup, INIT_TIMEOUT
 
 
-class Extractor:
-    def __init__(self, dir, template_path):
-        self.dir = dir
-        self.t = None
-        if os.path.exists(template_path):
-            self.t = cv2.imdecode(
-                np.fromfile(template_path, dtype=np.uint8), cv2.IMREAD_GRAYSCALE
-            )
+class ExtractThread(QThread):
+    finished = Signal(int, name="finished")
+    complete = Signal(int, int, name="complete")
 
-    def resetTemplate(self, template_path):
-        if os.path.exists(template_path):
-            self.t = cv2.imdecode(
-                np.fromfile(template_path, dtype=np.uint8), cv2.IMREAD_GRAYSCALE
-            )
+    def __init__(
+        self,
+        info_c,
+        extractor,
+        img_names,
+        num_workers=None,
+        incremental=False,
+        parent=None,
+    ):
+        super(ExtractThread, self).__init__(parent)
+        self.is_stop = False
 
-    def wellExtract(self, img_name: str):
-        match_thre = 0.15
+        self.info_c = info_c
+        self.extractor = extractor
+        self.img_names = img_names
+        self.num_workers = num_workers or min(os.cpu_count() or 1, MAX_WORKERS)
+        self.incremental = incremental
+        self.failed = []  # (img_name, error)
+        self.num_skipped = 0
 
-        img_path = os.path.join(self.dir, img_name)
-        src_color = cv2.imdecode(
-            np.fromfile(img_path, dtype=np.uint8), cv2.IMREAD_COLOR
-        )
-        src_gray = cv2.cvtColor(src_color, cv2.COLOR_BGR2GRAY)
+    def oldFingerprint(self, img_name):
+        if self.incremental and self.info_c.hasExtracted(img_name):
+            return self.info_c.getFingerprint(img_name)
+        return None
+
+    def run(self):
+        num_workers = max(1, min(self.num_workers, len(self.img_names)))
+        if num_workers == 1:
+            self.runInThread()
+        else:
+            self.runInPool(num_workers)
 
-        img_binary = cv2.adaptiveThreshold(
-            src_gray, 255, cv2.ADAPTIVE_THRESH_MEAN_C, cv2.THRESH_BINARY, 25, 10
+    def runInThread(self):
+        # one image, or one worker, is not worth starting a process
+        num_done = 0
+        for img_name in self.img_names:
+            if self.is_stop:
+                break
+            future = Future()
+            try:
+                old_fingerprint = self.oldFingerprint(img_name)
+                future.set_result(extractImage(self.extractor, img_name, old_fingerprint))
+            except Exception as e:
+                future.set_exception(e)
+            num_done += self.collect(img_name, future)
+            self.complete.emit(num_done, len(self.img_names))
+        self.finished.emit(num_done)
+
+    def runInPool(self, num_workers):
+        pool = ProcessPoolExecutor(
+            max_workers=num_workers,
+            mp_context=multiprocessing.get_context("spawn"),
+            initializer=initExtractWorker,
+            initargs=(self.extractor,),
         )
+        pending = {}
+        for img_name in self.img_names:
+            future = pool.submit(extractWorker, img_name, self.oldFingerprint(img_name))
+            pending[future] = img_name
+        num_done = 0
+        while pending and not self.is_stop:
+            done, _ = wait(pending, timeout=0.2, return_when=FIRST_COMPLETED)
+            for future in done:
+                num_done += self.collect(pending.pop(future), future)
+                self.complete.emit(num_done, len(self.img_names))
 
-        result = cv2.matchTemplate(img_binary, self.t, cv2.TM_CCOEFF_NORMED)
+        # keep whatever was still running when the job was stopped
+        pool.shutdown(wait=True, cancel_futures=True)
+        for future, img_name in pending.items():
+            if future.done() and not future.cancelled():
+                num_done += self.collect(img_name, future)
 
-        wells_loc = []
-        while True:
-            minVal, maxVal, minLoc, maxLoc = cv2.minMaxLoc(result)
-            if maxVal < match_thre:
-                break
+        self.finished.emit(num_done)
 
-            wells_loc.append(maxLoc)
-            t_h, t_w = self.t.shape[::-1]
+    def collect(self, img_name, future):
+        try:
+            img_name, wells_loc, fingerprint = future.result()
+        except Exception as e:
+            self.failed.append((img_name, e))
+            return 0
+        if wells_loc is None:
+            self.num_skipped += 1
+        else:
+            writeExtracted(self.info_c, img_name, wells_loc, self.extractor.t.shape)
+        self.info_c.setFingerprint(img_name, fingerprint)
+        return 1
+
+    def stop(self):
+        self.is_stop = True
+
+
+def writeExtracted(info_c, img_name, wells_loc, t_shape, store=None, img=None):
+    """
+    Write the wells of an image. Given the well store and the decoded image,
+    their crops are also put in the store and returned.
+    """
+    rects = [(loc[0], loc[1], t_shape[1], t_shape[0]) for loc in wells_loc]
+    with open(info_c.P_EXTARCT.format(img_name=img_name), "w") as f:
+        for x, y, w, h in rects:
+            f.write(f"{x},{y},{w},{h},{-1}\n")
 
-            p1 = (maxLoc[0] - t_w // 2, maxLoc[1] - t_h // 2)
-            p2 = (maxLoc[0] + t_w // 2, maxLoc[1] + t_h // 2)
-            cv2.rectangle(result, p1, p2, 0, thickness=cv2.FILLED)
-        return wells_loc
+    # row/column indices of grid extraction, one line per extracted well, for
+    # analysis outside the app
+    grid_path = info_c.P_GRID.format(img_name=img_name)
+    if wells_loc and len(wells_loc[0]) == 4:
+        with open(grid_path, "w") as f:
+            for loc in wells_loc:
+                f.write(f"{loc[2]},{loc[3]}\n")
+    elif os.path.exists(grid_path):
+        os.remove(grid_path)
+
+    if store is not None and img is not None:
+        crops = cropWells(img, rects)
+        img_path = info_c.P_IMAGE.format(img_name=img_name)
+        store.put(img_name, "extraction", img_path, rects, crops)
+        return crops
+    return None
+
+
+def writeClassified(info_c, img_name, wells_loc, predicted):
+    with open(info_c.P_CLASSIFY.format(img_name=img_name), "w") as f:
+        for loc, label in zip(wells_loc, predicted):
+            x, y, w, h = loc
+            f.write(f"{x},{y},{w},{h},{label}\n")
 
 
 def getWellsTensor(img, wells_loc):
-    well_tensors = []
-    for loc in wells_loc:
-        x, y, w, h = loc
-        well = img[y : y + h, x : x + w]
-        well = cv2.resize(well, (32, 32))
-        well_tensor = torch.from_numpy(well).permute(2, 0, 1).unsqueeze(0).float()
-        well_tensor = well_tensor / 255.0
-        norm = transforms.Normalize(mean=[0.5, 0.5, 0.5], std=[0.5, 0.5, 0.5])
-        well_tensor = norm(well_tensor)
-        well_tensors.append(well_tensor)
+    return normalizeWells(cropWells(img, wells_loc))
 
-    wells_tensor = torch.cat(well_tensors, dim=0)
-    return wells_tensor
+
+def editedWells(info_c, limit=4096):
+    """Crops and labels of up to limit edited wells, to calibrate and compare models."""
+    store = WellStore(info_c.P_WELLS)
+    crops, labels = [], []
+    for img_name in info_c.getImageNamesByFilter(([True, False], [True, False], [True])):
+        if len(labels) >= limit:
+            break
+        rects, img_labels = readEdit(info_c.P_EDIT.format(img_name=img_name))
+        img_path = info_c.P_IMAGE.format(img_name=img_name)
+        img_crops = store.load(img_name, "edit", img_path, rects)
+        crops.append(img_crops[img_labels >= 0])
+        labels.extend(img_labels[img_labels >= 0].tolist())
+    store.flush()
+    crops = np.concatenate(crops) if crops else np.empty((0, 32, 32, 3), np.uint8)
+    return crops[:limit], labels[:limit]
 
 
 class ClassifyThread(QThread):
@@ -79,6 +187,13 @@ class ClassifyThread(QThread):
         info_c,
         model_path,
         img_names,
+        batch_size=0,
+        memory_mb=1024,
+        num_workers=0,
+        prefetch=4,
+        cpu_mode="fp32",
+        num_shards=0,
+        precision="fp32",
         parent=None,
     ):
         super(ClassifyThread, self).__init__(parent)
@@ -87,53 +202,300 @@ class ClassifyThread(QThread):
         self.info_c = info_c
         self.model_path = model_path
         self.img_names = img_names
+        self.batch_size = batch_size
+        self.memory_mb = memory_mb
+        self.num_workers = num_workers
+        self.prefetch = max(prefetch, 1)
+        self.cpu_mode = cpu_mode
+        self.num_shards = num_shards
+        self.precision = precision
+        self.timing = {}
+        self.optimize_report = None
+        self.failed = []  # (img_name, error)
         self.device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
 
     def isUsingCpu(self):
         return self.device == torch.device("cpu")
 
+    def modelPrecision(self):
+        # the optimized CPU graphs have their own precision
+        if self.isUsingCpu() and self.cpu_mode != "fp32":
+            return "fp32"
+        return self.precision
+
     def run(self):
-        model = torch.load(self.model_path)
-        model.to(self.device)
-        model.eval()
-        for idx, img_name in enumerate(self.img_names):
-            if self.is_stop:
-                break
-            img_path = self.info_c.P_IMAGE.format(img_name=img_name)
-            img = cv2.imdecode(np.fromfile(img_path, dtype=np.uint8), cv2.IMREAD_COLOR)
+        if self.isUsingCpu() and self.num_shards > 1 and len(self.img_names) > 1:
+            self.runSharded()
+            return
 
-            wells_loc = []
-            extract_path = self.info_c.P_EXTARCT.format(img_name=img_name)
-            with open(extract_path, "r") as f:
-                lines = f.readlines()
-                for line in lines:
-                    x, y, w, h, label = map(int, line.split(","))
-                    wells_loc.append((x, y, w, h))
+        start = time.perf_counter()
+        self.timing = dict.fromkeys(
+            ["store", "decode", "parse", "crop", "wait", "infer"], 0.0
+        )
+        model, batch_size = self.prepareModel()
+        batcher = WellBatcher(batch_size)
 
-            wells = getWellsTensor(img, wells_loc)
-            with torch.no_grad():
-                wells = wells.to(self.device)
-                output = model(wells)
-                _, predicted = torch.max(output, 1)
+        # wells of all images stream through fixed-size batches
+        num_done = 0
+        images = self.loadImages()
+        while not self.is_stop:
+            waited = time.perf_counter()
+            image = next(images, None)
+            self.timing["wait"] += time.perf_counter() - waited
+            if image is None:
+                break
+            img_name, wells_loc, crops, timing = image
+            for stage, elapsed in timing.items():
+                self.timing[stage] += elapsed
 
-            predicted = predicted.cpu().numpy()
-            classified_path = self.info_c.P_CLASSIFY.format(img_name=img_name)
-            with open(classified_path, "w") as f:
-                for loc, label in zip(wells_loc, predicted):
-                    x, y, w, h = loc
-                    f.write(f"{x},{y},{w},{h},{label}\n")
+            batcher.add(img_name, wells_loc, crops)
+            while batcher.isFull():
+                self.inferBatch(model, batcher)
+            num_done = self.writeFinished(batcher, num_done)
+        images.close()
 
-            self.complete.emit(idx + 1, len(self.img_names))
+        while not batcher.isEmpty() and not self.is_stop:
+            self.inferBatch(model, batcher)
+        self.writeFinished(batcher, num_done)
 
+        self.timing["total"] = time.perf_counter() - start
         self.finished.emit(len(self.img_names))
 
+    def runSharded(self):
+        # images are dealt round-robin to processes on disjoint sets of cores
+        start = time.perf_counter()
+        _, batch_size = self.prepareModel(self.memory_mb / self.num_shards)
+        cores = sorted(os.sched_getaffinity(0)) if hasattr(os, "sched_getaffinity") else []
+        cores = cores or list(range(os.cpu_count() or 1))
+        num_shards = min(self.num_shards, len(self.img_names), len(cores))
+
+        ctx = multiprocessing.get_context("spawn")
+        queue = ctx.Queue()
+        stop_event = ctx.Event()
+        jobs = self.imageJobs()
+        shards = []
+        for idx, shard_cores in enumerate(np.array_split(cores, num_shards)):
+            shard = ctx.Process(
+                target=classifyShard,
+                args=(
+                    set(int(c) for c in shard_cores),
+                    self.model_path,
+                    self.cpu_mode,
+                    self.modelPrecision(),
+                    jobs[idx::num_shards],
+                    batch_size,
+                    self.info_c.P_WELLS,
+                    queue,
+                    stop_event,
+                ),
+            )
+            shard.start()
+            shards.append(shard)
+
+        # predictions come back here, this thread is the only writer
+        num_done = 0
+        written = set()
+        num_running = num_shards
+        while num_running:
+            if self.is_stop:
+                stop_event.set()
+            try:
+                finished = queue.get(timeout=0.2)
+            except Empty:
+                if not any(shard.is_alive() for shard in shards):
+                    break
+                continue
+            if finished is None:
+                num_running -= 1
+                continue
+            if isinstance(finished, dict):
+                self.failed += [(name, finished["error"]) for name in finished["img_names"]]
+                continue
+            writeClassified(self.info_c, *finished)
+            written.add(finished[0])
+            num_done += 1
+            self.complete.emit(num_done, len(self.img_names))
+        for shard in shards:
+            shard.join()
+
+        # a shard that was killed sent nothing for its unfinished images
+        if not self.is_stop:
+            failed = {name for name, _ in self.failed}
+            for img_name in self.img_names:
+                if img_name not in written and img_name not in failed:
+                    self.failed.append((img_name, "Classification process exited."))
+
+        self.timing = {"total": time.perf_counter() - start}
+        self.finished.emit(num_done)
+
+    def imageJobs(self):
+        return [
+            (
+                img_name,
+                self.info_c.P_IMAGE.format(img_name=img_name),
+                self.info_c.P_EXTARCT.format(img_name=img_name),
+            )
+            for img_name in self.img_names
+        ]
+
+    def prepareModel(self, memory_mb=None):
+        model = loadModel(self.model_path, self.device)
+        # the fp32 estimate also bounds the optimized graphs
+        memory_mb = memory_mb or self.memory_mb
+        batch_size = self.batch_size or autoBatchSize(model, self.device, memory_mb)
+        if self.isUsingCpu() and self.cpu_mode != "fp32":
+            if not isFresh(self.model_path, self.cpu_mode):
+                crops, labels = editedWells(self.info_c)
+                buildOptimized(
+                    self.model_path, self.cpu_mode, model, normalizeWells(crops), labels
+                )
+            self.optimize_report = loadReport(self.model_path, self.cpu_mode)
+            model_path = artifactPath(self.model_path, self.cpu_mode)
+            model = loadModel(model_path, self.device, torch.jit.load)
+        return model, batch_size
+
+    def loadImages(self):
+        # crops come from the well store while up to date, otherwise the image
+        # is decoded, ahead in worker processes when num_workers > 0
+        store = WellStore(self.info_c.P_WELLS)
+        pool = None
+        queue = deque()
+        try:
+            for img_name, img_path, extract_path in self.imageJobs():
+                start = time.perf_counter()
+                wells_loc = readWellsLoc(extract_path)
+                crops = store.get(img_name, "extraction", img_path, wells_loc)
+                if crops is not None:
+                    loaded = (wells_loc, crops, {"store": time.perf_counter() - start})
+                elif not self.num_workers:
+                    loaded = loadCrops(img_path, extract_path)
+                else:
+                    if pool is None:
+                        pool = ProcessPoolExecutor(
+                            max_workers=max(1, min(self.num_workers, len(self.img_names))),
+                            mp_context=multiprocessing.get_context("spawn"),
+                        )
+                    loaded = pool.submit(loadCrops, img_path, extract_path)
+                queue.append((img_name, img_path, loaded))
+
+                # at most prefetch images are decoded ahead of the inference loop
+                while len(queue) >= (self.prefetch if self.num_workers else 1):
+                    yield self.storeLoaded(store, *queue.popleft())
+            while queue:
+                yield self.storeLoaded(store, *queue.popleft())
+        finally:
+            store.flush()
+            if pool is not None:
+                pool.shutdown(wait=True, cancel_futures=True)
+
+    def storeLoaded(self, store, img_name, img_path, loaded):
+        if isinstance(loaded, Future):
+            loaded = loaded.result()
+        wells_loc, crops, timing = loaded
+        if "store" not in timing:
+            store.put(img_name, "extraction", img_path, wells_loc, crops)
+        return img_name, wells_loc, crops, timing
+
+    def inferBatch(self, model, batcher):
+        start = time.perf_counter()
+        classifyBatch(model, batcher, self.device, self.modelPrecision())
+        self.timing["infer"] += time.perf_counter() - start
+
+    def timingReport(self):
+        # with workers the stages overlap, so they add up to more than total
+        if not self.timing:
+            return ""
+        stages = ", ".join(
+            f"{stage} {elapsed:.1f}s" for stage, elapsed in self.timing.items()
+        )
+        return f"Time: {stages}."
+
+    def writeFinished(self, batcher, num_done):
+        for img_name, wells_loc, predicted in batcher.popFinished():
+            writeClassified(self.info_c, img_name, wells_loc, predicted)
+            num_done += 1
+            self.complete.emit(num_done, len(self.img_names))
+        return num_done
+
     def stop(self):
         self.is_stop = True
 
 
+class PipelineThread(ClassifyThread):
+    """
+    Extraction and classification off a single decode of each image. Wells
+    and crops stay in memory, both result files are still written.
+    """
+
+    def __init__(
+        self,
+        info_c,
+        extractor,
+        model_path,
+        img_names,
+        batch_size=0,
+        memory_mb=1024,
+        cpu_mode="fp32",
+        precision="fp32",
+        parent=None,
+    ):
+        super(PipelineThread, self).__init__(
+            info_c,
+            model_path,
+            img_names,
+            batch_size,
+            memory_mb,
+            cpu_mode=cpu_mode,
+            precision=precision,
+            parent=parent,
+        )
+        self.extractor = extractor
+
+    def run(self):
+        start = time.perf_counter()
+        self.timing = {"infer": 0.0}
+        model, batch_size = self.prepareModel()
+        batcher = WellBatcher(batch_size)
+
+        store = WellStore(self.info_c.P_WELLS)
+        t_h, t_w = self.extractor.t.shape
+        num_done = 0
+        for img_name in self.img_names:
+            if self.is_stop:
+                break
+            img_path = self.info_c.P_IMAGE.format(img_name=img_name)
+            data = np.fromfile(img_path, dtype=np.uint8)
+            img = cv2.imdecode(data, cv2.IMREAD_COLOR)
+
+            # extraction
+            fingerprint = fileFingerprint(img_path, data=data)
+            fingerprint["params"] = self.extractor.paramsDigest()
+            wells = self.extractor.wellExtract(img_name, data, img)
+            crops = writeExtracted(
+                self.info_c, img_name, wells, self.extractor.t.shape, store, img
+            )
+            self.info_c.setFingerprint(img_name, fingerprint)
+
+            # classification
+            wells_loc = [(loc[0], loc[1], t_w, t_h) for loc in wells]
+            batcher.add(img_name, wells_loc, crops)
+            while batcher.isFull():
+                self.inferBatch(model, batcher)
+            num_done = self.writeFinished(batcher, num_done)
+        store.flush()
+
+        while not batcher.isEmpty() and not self.is_stop:
+            self.inferBatch(model, batcher)
+        self.writeFinished(batcher, num_done)
+
+        self.timing["total"] = time.perf_counter() - start
+        self.finished.emit(len(self.img_names))
+
+
 class TrainThread(QThread):
     finished = Signal()
     complete = Signal(int, int, float, name="complete")
+    validated = Signal(int, float, float, name="validated")
 
     def __init__(
         self,
@@ -142,6 +504,18 @@ class TrainThread(QThread):
         model_type,
         max_epoch,
         batch_size,
+        batch_augment=False,
+        lazy_dataset=False,
+        num_workers=-1,
+        prefetch=2,
+        pin_memory=True,
+        persistent_workers=True,
+        val_percent=20,
+        patience=10,
+        keep_checkpoints=3,
+        resume_path="",
+        precision="fp32",
+        num_processes=1,
         parent=None,
     ):
         super(TrainThread, self).__init__(parent)
@@ -152,93 +526,585 @@ class TrainThread(QThread):
         self.model_type = model_type
         self.max_epoch = max_epoch
         self.batch_size = batch_size
+        self.batch_augment = batch_augment
+        self.lazy_dataset = lazy_dataset
+        self.dataset_report = None
+        self.num_workers = num_workers  # -1 to choose from cores and dataset size
+        self.prefetch = max(prefetch, 1)
+        self.pin_memory = pin_memory
+        self.persistent_workers = persistent_workers
+        self.loader_report = None
+        self.val_percent = val_percent
+        self.patience = patience  # epochs without a better validation, 0 never stops
+        self.train_report = None
+        self.keep_checkpoints = keep_checkpoints
+        self.resume_path = resume_path  # a checkpoint to go on from
+        self.precision = precision  # autocast of the training step, see PRECISIONS
+        self.writer = None
+        self.best = None  # (accuracy, -loss) of the best validation
+        self.improved_epoch = 0  # last epoch that raised the validation accuracy
+        self.num_processes = num_processes  # data-parallel CPU processes, batch_size each
+        self.ranks = []
+        self.error = None  # what ended the run early, shown with the results
         self.device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
 
     def isUsingCpu(self):
         return self.device == torch.device("cpu")
 
+    def splitImages(self, img_names):
+        """Validation images, a fixed random share of the edited images."""
+        if len(img_names) < 2 or self.val_percent <= 0:
+            return set()
+        num_val = min(max(round(len(img_names) * self.val_percent / 100), 1), len(img_names) - 1)
+        rng = np.random.default_rng(0)
+        return set(rng.choice(sorted(img_names), num_val, replace=False).tolist())
+
     def getDataset(self):
+        """
+        Training and validation datasets, split by image so that wells of one
+        plate are never on both sides. The validation set is None when there
+        are not two edited images.
+        """
+        # one image decoded at a time, only its 32x32 crops are kept (or, lazily,
+        # only their rows in the well store), unchanged images are not decoded
+        start = time.perf_counter()
+        resetPeakRss()
         img_names_edit = self.info_c.getImageNamesByFilter(
             _filter=([True, False], [True, False], [True])
         )
         if len(img_names_edit) == 0:
-            return None
-        well_imgs = []
-        class_idxs = []
+            return None, None
+        val_names = self.splitImages(img_names_edit)
+        store = WellStore(self.info_c.P_WELLS)
+        parts = {False: [], True: []}  # (img_name, keep, crops, labels) by is_val
         for img_name in img_names_edit:
             img_path = self.info_c.P_IMAGE.format(img_name=img_name)
-            img = cv2.imdecode(np.fromfile(img_path, dtype=np.uint8), cv2.IMREAD_COLOR)
-            edit_path = self.info_c.P_EDIT.format(img_name=img_name)
-            with open(edit_path, "r") as f:
-                lines = f.readlines()
-                for line in lines:
-                    x, y, w, h, label = map(int, line.split(","))
-                    well_img = img[y : y + h, x : x + w]
-                    well_imgs.append(well_img)
-                    class_idxs.append(label)
-
-        dataset = WellDataset(well_imgs, class_idxs)
-        return dataset
+            rects, labels = readEdit(self.info_c.P_EDIT.format(img_name=img_name))
+            keep = labels >= 0  # unlabelled wells are not trained on
+            if self.lazy_dataset:
+                if not store.has(img_name, "edit", img_path, rects):
+                    store.load(img_name, "edit", img_path, rects)
+                crops = None
+            else:
+                crops = store.load(img_name, "edit", img_path, rects)[keep]
+            parts[img_name in val_names].append((img_name, keep, crops, labels[keep]))
+        store.flush()
+
+        def build(parts, augment):
+            class_idxs = np.concatenate([labels for _, _, _, labels in parts])
+            if not len(class_idxs):
+                return None
+            if self.lazy_dataset:
+                # rows are read after all puts, a compaction may have moved them
+                rows = np.concatenate(
+                    [store.rows(name, "edit")[keep] for name, keep, _, _ in parts]
+                )
+                return DiskWellDataset(
+                    store.P_WELLS, store.index["rows"], rows, class_idxs, augment
+                )
+            wells = np.concatenate([crops for _, _, crops, _ in parts])
+            return WellDataset(wells, class_idxs, augment)
+
+        train_set = build(parts[False], not self.batch_augment) if parts[False] else None
+        val_set = build(parts[True], False) if parts[True] else None
+        if train_set is None:
+            return None, None
+
+        self.dataset_report = {
+            "wells": len(train_set),
+            "val_wells": len(val_set) if val_set is not None else 0,
+            "val_images": len(parts[True]),
+            "lazy": self.lazy_dataset,
+            "seconds": time.perf_counter() - start,
+            "peak_rss_mb": peakRssMb(),
+        }
+        return train_set, val_set
+
+    def getLoader(self, dataset, sampler=None):
+        num_batches = math.ceil(len(dataset) / self.batch_size)
+        num_workers = self.num_workers
+        if num_workers < 0:
+            # worker start-up does not pay off for a few batches per epoch, and
+            # data-parallel ranks already use the cores
+            spare = (os.cpu_count() or 1) - 1
+            num_workers = min(spare, 4) if num_batches >= 16 and sampler is None else 0
+        pin_memory = self.pin_memory and self.device.type == "cuda"
+
+        options = {}
+        if num_workers:
+            dataset.shareMemory()
+            options = {
+                "persistent_workers": self.persistent_workers,
+                "prefetch_factor": self.prefetch,
+                "multiprocessing_context": "spawn",
+            }
+        self.loader_report = {
+            "workers": num_workers,
+            "pin_memory": pin_memory,
+            "processes": sampler.num_replicas if sampler is not None else 1,
+            "wells": 0,
+            "data_s": 0.0,
+            "compute_s": 0.0,
+        }
+        return torch.utils.data.DataLoader(
+            dataset,
+            batch_size=self.batch_size,
+            shuffle=sampler is None,
+            sampler=sampler,
+            num_workers=num_workers,
+            pin_memory=pin_memory,
+            **options,
+        )
 
     def saveModel(self, model):
         model_path = self.info_c.P_MODEL.format(
             model_type=self.model_type, time=self.time_str
         )
-        torch.save(model, model_path)
+        self.writer.save(modelState(model, self.model_type, self.precision), model_path)
+
+    def saveCheckpoint(self, model, optimizer, scaler, epoch, finished):
+        """
+        Everything needed to go on after epoch, the last keep of a run are
+        kept. Only runs that were not finished, by the last epoch or an early
+        stop, are resumed.
+        """
+        state = modelState(model, self.model_type, self.precision)
+        state.update(
+            time=self.time_str,
+            epoch=epoch,
+            optimizer=optimizer.state_dict(),
+            scaler=scaler.state_dict(),
+            train_report=dict(self.train_report),
+            finished=finished,
+            best=self.best,
+            improved_epoch=self.improved_epoch,
+            rng=torch.get_rng_state(),
+            cuda_rng=torch.cuda.get_rng_state_all() if torch.cuda.is_available() else [],
+        )
+        kwargs = {"model_type": self.model_type, "time": self.time_str}
+        self.writer.save(
+            state,
+            self.info_c.P_CHECKPOINT.format(epoch=epoch, **kwargs),
+            self.info_c.P_CHECKPOINT.replace("{epoch:04d}", "*").format(**kwargs),
+        )
 
     def run(self):
+        # finished is always emitted, an error is reported with the results
+        try:
+            self.train()
+        except Exception as e:
+            self.error = f"{type(e).__name__}: {e}"
+        self.finished.emit()
+
+    def train(self):
         self.time_str = time.strftime("%Y%m%d%H%M%S", time.localtime())
-        if not self.model_path:
-            class_num = len(self.info_c.class_names)
-            if self.model_type == "MobileNet":
-                model = MobileNet(class_num)
-            elif self.model_type == "Resnet18":
-                model = Resnet18(class_num)
-            elif self.model_type == "Resnet50":
-                model = Resnet50(class_num)
-            else:
+        checkpoint = None
+        if self.resume_path:
+            # the run goes on under its own name, after its last finished epoch
+            checkpoint = torch.load(self.resume_path, weights_only=False, map_location="cpu")
+            self.model_type = checkpoint["model_type"]
+            self.time_str = checkpoint["time"]
+            # checkpoints from before the precision setting are fp32
+            self.precision = checkpoint.get("precision", "fp32")
+            if self.precision == "fp16" and self.isUsingCpu():
+                raise ValueError("The run was trained with fp16, which needs CUDA.")
+            model = buildModel(checkpoint)
+        elif not self.model_path:
+            if self.model_type not in MODELS:
                 raise ValueError("Invalid model type")
+            model = MODELS[self.model_type](len(self.info_c.class_names))
         else:
-            model = torch.load(self.model_path)
+            model = readModel(self.model_path)
 
         model.to(self.device)
         model.train()
         criterion = torch.nn.CrossEntropyLoss()
         optimizer = torch.optim.Adam(model.parameters(), lr=0.001)
-        dataset = self.getDataset()
+        # fp16 gradients underflow without loss scaling, bf16 has the fp32 range
+        scaler = torch.amp.GradScaler(self.device.type, enabled=self.precision == "fp16")
+        dataset, val_set = self.getDataset()
         if dataset is None:
-            self.finished.emit()
             return
-        dataloader = torch.utils.data.DataLoader(
-            dataset, batch_size=self.batch_size, shuffle=True
-        )
-        min_loss = 0.0
-        for epoch in range(self.max_epoch):
-            for i, (inputs, labels) in enumerate(dataloader):
-                if self.is_stop:
+        self.resetBest()
+        start_epoch = 0
+        if checkpoint is not None:
+            optimizer.load_state_dict(checkpoint["optimizer"])
+            if "scaler" in checkpoint:
+                scaler.load_state_dict(checkpoint["scaler"])
+            self.train_report = checkpoint["train_report"]
+            self.best = checkpoint["best"]
+            self.improved_epoch = checkpoint["improved_epoch"]
+            start_epoch = checkpoint["epoch"]
+            torch.set_rng_state(checkpoint["rng"])
+            if checkpoint["cuda_rng"] and torch.cuda.is_available():
+                torch.cuda.set_rng_state_all(checkpoint["cuda_rng"])
+
+        # with several processes, net is the model and model its DDP wrapper
+        net = model
+        sampler = None
+        epochs = range(start_epoch, self.max_epoch)
+        num_threads = torch.get_num_threads()
+        self.writer = None
+        try:
+            if self.isUsingCpu() and self.num_processes > 1:
+                started = self.startRanks(net, dataset, start_epoch)
+                if started is None:
+                    # stopped while the ranks started, they are not waited for
+                    epochs = []
+                    self.stopRanks(num_threads, timeout=0)
+                else:
+                    model, sampler = started
+            dataloader = self.getLoader(dataset, sampler)
+            report = self.loader_report
+            # flips, rotation and affine on whole batches, on the training device
+            augment = BatchAugment() if self.batch_augment else None
+
+            # models and checkpoints are written in the background
+            self.writer = CheckpointWriter(self.keep_checkpoints)
+            for epoch in epochs:
+                if sampler is not None:
+                    sampler.set_epoch(epoch)
+                # time waiting for the loader against time of the training step
+                data_s, compute_s, stopped = trainEpoch(
+                    model,
+                    dataloader,
+                    optimizer,
+                    scaler,
+                    augment,
+                    self.device,
+                    self.precision,
+                    report["pin_memory"],
+                    lambda: self.is_stop,
+                    lambda i, loss: self.complete.emit(epoch + 1, i, loss),
+                    sampler is not None,
+                )
+                report["data_s"] += data_s
+                report["compute_s"] += compute_s
+                # a stopped epoch is not saved, resuming repeats it
+                if stopped:
                     break
+                report["wells"] += len(dataset)
+                self.train_report["epochs"] = epoch + 1
+
+                # without validation images the last epoch is kept
+                stop = False
+                if val_set is not None:
+                    val_loss, val_accuracy = self.validate(net, val_set, criterion)
+                    is_best, stop = self.trackBest(epoch + 1, val_loss, val_accuracy)
+                    if is_best:
+                        self.saveModel(net)
+                self.saveCheckpoint(
+                    net, optimizer, scaler, epoch + 1, stop or epoch + 1 >= self.max_epoch
+                )
+                if sampler is not None:
+                    dist.broadcast(torch.tensor([float(stop)]), 0)
+                if stop:
+                    break
+
+            if val_set is None and self.train_report["epochs"]:
+                self.saveModel(net)
+        except BaseException:
+            # the ranks may wait in a collective for this one, they are killed
+            self.stopRanks(num_threads, timeout=0)
+            raise
+        finally:
+            self.stopRanks(num_threads)
+            if self.writer is not None:
+                error = self.writer.close()
+                if error is not None:
+                    self.train_report["save_error"] = str(error)
+
+    def startRanks(self, model, dataset, start_epoch):
+        """
+        Spawn ranks 1 to num_processes - 1 on their own cores, join them as
+        rank 0 and return the model wrapped for gradient all-reduce, and this
+        rank's sampler, or None when stopped before all ranks joined. The
+        wells are shared with the ranks, not copied.
+        """
+        cores = sorted(os.sched_getaffinity(0)) if hasattr(os, "sched_getaffinity") else []
+        cores = cores or list(range(os.cpu_count() or 1))
+        world_size = self.num_processes
+        # with fewer cores than processes, the ranks share all of them
+        if len(cores) >= world_size:
+            parts = np.array_split(cores, world_size)
+        else:
+            parts = [cores] * world_size
+        core_sets = [set(int(c) for c in part) for part in parts]
+        port = freePort()
+        store = rankStore(port, world_size, 0)
+        config = {
+            "batch_size": self.batch_size,
+            "batch_augment": self.batch_augment,
+            "precision": self.precision,
+            "max_epoch": self.max_epoch,
+            "start_epoch": start_epoch,
+            "resume_path": self.resume_path,
+        }
+
+        dataset.shareMemory()
+        ctx = torch.multiprocessing.get_context("spawn")
+        self.ranks = []
+        for rank in range(1, world_size):
+            process = ctx.Process(
+                target=trainRank,
+                args=(
+                    rank,
+                    world_size,
+                    port,
+                    core_sets[rank],
+                    cpuCopy(modelState(model, self.model_type, self.precision)),
+                    config,
+                    dataset,
+                ),
+            )
+            process.start()
+            self.ranks.append(process)
+
+        # wait for the ranks here, where a dead rank or a stop can end the wait
+        deadline = time.monotonic() + INIT_TIMEOUT
+        while store.add("joined", 0) < world_size - 1:
+            if self.is_stop:
+                return None
+            if not all(process.is_alive() for process in self.ranks):
+                raise RuntimeError("A training process exited while starting.")
+            if time.monotonic() > deadline:
+                raise RuntimeError("Training processes did not start in time.")
+            time.sleep(0.1)
+
+        torch.set_num_threads(len(core_sets[0]))
+        joinGroup(store, 0, world_size)
+        sampler = DistributedSampler(dataset, world_size, 0, seed=0)
+        return DistributedDataParallel(model), sampler
+
+    def stopRanks(self, num_threads, timeout=10):
+        """Leave the process group and end the ranks, those still waiting are killed."""
+        if dist.is_initialized():
+            dist.destroy_process_group()
+        for process in self.ranks:
+            process.join(timeout)
+            if process.is_alive():
+                process.terminate()
+                process.join()
+        self.ranks = []
+        torch.set_num_threads(num_threads)
+
+    def resetBest(self):
+        self.train_report = {
+            "precision": self.precision,
+            "epochs": 0,
+            "val_accuracy": None,
+            "best_epoch": 0,
+            "best_accuracy": None,
+            "best_loss": None,
+            "early_stop": False,
+        }
+        self.best = None
+        self.improved_epoch = 0
+
+    def trackBest(self, epoch, val_loss, val_accuracy):
+        """Record a validation, return whether it is the best yet and whether to stop."""
+        self.validated.emit(epoch, val_loss, val_accuracy)
+        self.train_report["val_accuracy"] = val_accuracy
+        # best by accuracy, ties by loss, but only a better accuracy resets the
+        # patience, the loss keeps shrinking long after the accuracy settles
+        if self.best is None or val_accuracy > self.best[0]:
+            self.improved_epoch = epoch
+        is_best = self.best is None or (val_accuracy, -val_loss) > tuple(self.best)
+        if is_best:
+            self.best = (val_accuracy, -val_loss)
+            self.train_report.update(
+                best_epoch=epoch, best_accuracy=val_accuracy, best_loss=val_loss
+            )
+        stop = bool(self.patience) and epoch - self.improved_epoch >= self.patience
+        self.train_report["early_stop"] = stop
+        return is_best, stop
+
+    def validate(self, model, val_set, criterion):
+        """Mean loss and accuracy on the validation wells, in eval mode."""
+        loader = torch.utils.data.DataLoader(val_set, batch_size=256)
+        total_loss, num_correct = 0.0, 0
+        model.eval()
+        with torch.no_grad(), autocast(self.device, self.precision):
+            for inputs, labels in loader:
                 inputs = inputs.to(self.device)
                 labels = labels.to(self.device)
-
-                optimizer.zero_grad()
                 outputs = model(inputs)
-                print(outputs.shape, labels.shape)
-                loss = criterion(outputs, labels)
-                loss.backward()
-                optimizer.step()
+                total_loss += criterion(outputs, labels).item() * len(labels)
+                num_correct += (outputs.argmax(1) == labels).sum().item()
+        model.train()
+        return total_loss / len(val_set), num_correct / len(val_set)
 
-                if loss.item() < min_loss:
-                    min_loss = loss.item()
-                    self.saveModel(model)
+    def trainText(self):
+        report = self.train_report
+        if not report:
+            return ""
+        if report["best_accuracy"] is None:
+            text = f"{report['epochs']} epochs, no validation images, last epoch saved."
+        else:
+            stop = ", stopped early" if report["early_stop"] else ""
+            text = (
+                f"{report['epochs']} epochs{stop}, best validation accuracy "
+                f"{report['best_accuracy'] * 100:.1f}% at epoch {report['best_epoch']}."
+            )
+        if report.get("precision", "fp32") != "fp32":
+            text += f" Trained with {report['precision']} autocast."
+        if "save_error" in report:
+            text += f" Saving failed: {report['save_error']}"
+        return text
 
-                if i % 10 == 0:
-                    self.complete.emit(epoch + 1, i + 1, loss.item())
-        self.finished.emit()
+    def loaderText(self):
+        report = self.loader_report
+        if not report:
+            return ""
+        total = max(report["data_s"] + report["compute_s"], 1e-9)
+        text = (
+            f"Loader: {report['workers']} workers, data wait {report['data_s']:.1f}s "
+            f"({report['data_s'] / total * 100:.0f}%), compute {report['compute_s']:.1f}s."
+        )
+        if report["processes"] > 1:
+            text += f" {report['processes']} processes, {report['wells'] / total:.0f} wells/s."
+        return text
 
     def stop(self):
         self.is_stop = True
 
 
+class HeadTrainThread(TrainThread):
+    """
+    Retrain only the head of a trained model, a linear layer or a small MLP,
+    on penultimate-layer features of the edited wells. Features are cached
+    per backbone and image, so a retrain after new edits only embeds the
+    changed images. The saved model is whole and loads like any other.
+    """
+
+    def __init__(
+        self,
+        info_c,
+        model_path,
+        model_type,
+        max_epoch,
+        batch_size,
+        head="linear",
+        val_percent=20,
+        patience=10,
+        parent=None,
+    ):
+        super(HeadTrainThread, self).__init__(
+            info_c,
+            model_path,
+            model_type,
+            max_epoch,
+            batch_size,
+            val_percent=val_percent,
+            patience=patience,
+            parent=parent,
+        )
+        self.head = head
+
+    def getFeatures(self, model):
+        """(features, labels) tensors for training and for validation, or None."""
+        start = time.perf_counter()
+        resetPeakRss()
+        img_names_edit = self.info_c.getImageNamesByFilter(
+            _filter=([True, False], [True, False], [True])
+        )
+        val_names = self.splitImages(img_names_edit)
+        cache = FeatureCache(self.info_c.P_FEATURES, self.model_path)
+        store = WellStore(self.info_c.P_WELLS)
+        parts = {False: ([], []), True: ([], [])}
+        num_cached = 0
+        for img_name in img_names_edit:
+            img_path = self.info_c.P_IMAGE.format(img_name=img_name)
+            rects, labels = readEdit(self.info_c.P_EDIT.format(img_name=img_name))
+            stamp = store.stamp(img_path, rects)
+            features = cache.get(img_name, stamp)
+            if features is None:
+                crops = store.load(img_name, "edit", img_path, rects)
+                features = embed(model, normalizeWells(crops).to(self.device))
+                cache.put(img_name, stamp, features)
+            else:
+                num_cached += 1
+            keep = labels >= 0
+            features_list, labels_list = parts[img_name in val_names]
+            features_list.append(features[keep])
+            labels_list.append(labels[keep])
+        store.flush()
+
+        def join(features_list, labels_list):
+            if not features_list or not sum(len(labels) for labels in labels_list):
+                return None
+            features = torch.from_numpy(np.concatenate(features_list)).to(self.device)
+            labels = torch.from_numpy(np.concatenate(labels_list)).to(self.device)
+            return features, labels
+
+        train, val = join(*parts[False]), join(*parts[True])
+        if train is None:
+            return None, None
+        self.dataset_report = {
+            "wells": len(train[1]),
+            "val_wells": len(val[1]) if val is not None else 0,
+            "val_images": len(val_names),
+            "cached_images": num_cached,
+            "lazy": False,
+            "seconds": time.perf_counter() - start,
+            "peak_rss_mb": peakRssMb(),
+        }
+        return train, val
+
+    def train(self):
+        self.time_str = time.strftime("%Y%m%d%H%M%S", time.localtime())
+        model = readModel(self.model_path, map_location=self.device)
+        model.to(self.device)
+        train, val = self.getFeatures(model)
+        if train is None:
+            return
+
+        features, labels = train
+        num_classes = len(self.info_c.class_names)
+        head = makeHead(self.head, features.shape[1], num_classes).to(self.device)
+        criterion = torch.nn.CrossEntropyLoss()
+        optimizer = torch.optim.Adam(head.parameters(), lr=0.001)
+        self.resetBest()
+        best_state = None
+        for epoch in range(self.max_epoch):
+            head.train()
+            for i, idxs in enumerate(torch.randperm(len(labels)).split(self.batch_size)):
+                if self.is_stop:
+                    break
+                optimizer.zero_grad()
+                loss = criterion(head(features[idxs]), labels[idxs])
+                loss.backward()
+                optimizer.step()
+            if self.is_stop:
+                break
+            self.complete.emit(epoch + 1, i + 1, loss.item())
+            self.train_report["epochs"] = epoch + 1
+
+            # without validation images the last epoch is kept
+            if val is None:
+                best_state = copy.deepcopy(head.state_dict())
+                continue
+            head.eval()
+            with torch.no_grad():
+                outputs = head(val[0])
+                val_loss = criterion(outputs, val[1]).item()
+                val_accuracy = (outputs.argmax(1) == val[1]).float().mean().item()
+            is_best, stop = self.trackBest(epoch + 1, val_loss, val_accuracy)
+            if is_best:
+                best_state = copy.deepcopy(head.state_dict())
+            if stop:
+                break
+
+        if best_state is not None:
+            head.load_state_dict(best_state)
+            setHead(model, head)
+            self.writer = CheckpointWriter()
+            self.saveModel(model)
+            error = self.writer.close()
+            if error is not None:
+                self.train_report["save_error"] = str(error)
+
+
 class AiContainer:
     def __init__(self):
         self.thread = None
@@ -0,0 +1,884 @@
+"""
+Benchmarks for the extraction and classification pipelines.
+
+Usage: python -m AIMWR.benchmark <name> [args]
+"""
+
+import os
+import sys
+import time
+import shutil
+import tempfile
+import multiprocessing
+import cv2
+import numpy as np
+
+from ._matching import findPeaks, pyramidPeaks, latticePeaks
+from ._tiles import GrayImage, tiledPeaks
+from ._memory import peakRssMb, resetPeakRss
+
+
+def syntheticPlate(rows, cols, pitch=40, radius=12, angle=0.0, seed=0):
+    """Draw a plate of dark round wells, return (color image, gray template)."""
+    rng = np.random.default_rng(seed)
+    margin = pitch
+    h = rows * pitch + 2 * margin
+    w = cols * pitch + 2 * margin
+    img = np.full((h, w), 200, dtype=np.uint8)
+    cos, sin = np.cos(np.radians(angle)), np.sin(np.radians(angle))
+    cx0, cy0 = w / 2, h / 2
+    for r in range(rows):
+        for c in range(cols):
+            dx = margin + c * pitch + pitch / 2 - cx0
+            dy = margin + r * pitch + pitch / 2 - cy0
+            x = int(round(cx0 + dx * cos - dy * sin))
+            y = int(round(cy0 + dx * sin + dy * cos))
+            cv2.circle(img, (x, y), radius, 60, 2)
+    noise = rng.normal(0, 8, img.shape)
+    img = np.clip(img + noise, 0, 255).astype(np.uint8)
+
+    size = 2 * radius + 6
+    t = np.full((size, size), 200, dtype=np.uint8)
+    cv2.circle(t, (size // 2, size // 2), radius, 60, 2)
+    return cv2.cvtColor(img, cv2.COLOR_GRAY2BGR), t
+
+
+def binarize(src_color):
+    src_gray = cv2.cvtColor(src_color, cv2.COLOR_BGR2GRAY)
+    return cv2.adaptiveThreshold(
+        src_gray, 255, cv2.ADAPTIVE_THRESH_MEAN_C, cv2.THRESH_BINARY, 25, 10
+    )
+
+
+def responseMap(src_color, t):
+    return cv2.matchTemplate(binarize(src_color), t, cv2.TM_CCOEFF_NORMED)
+
+
+def matchWells(ref, out, tol=2):
+    """Pair wells of out with wells of ref within tol pixels."""
+    ref_set = {}
+    for loc in ref:
+        ref_set.setdefault(tuple(loc[:2]), 0)
+        ref_set[tuple(loc[:2])] += 1
+    offsets = sorted(
+        ((dx, dy) for dx in range(-tol, tol + 1) for dy in range(-tol, tol + 1)),
+        key=lambda d: d[0] ** 2 + d[1] ** 2,
+    )
+    matched = 0
+    dists = []
+    for loc in out:
+        for dx, dy in offsets:
+            key = (loc[0] + dx, loc[1] + dy)
+            if ref_set.get(key, 0) > 0:
+                ref_set[key] -= 1
+                matched += 1
+                dists.append((dx**2 + dy**2) ** 0.5)
+                break
+    recall = matched / len(ref) if ref else 1.0
+    precision = matched / len(out) if out else 1.0
+    mean_dist = float(np.mean(dists)) if dists else 0.0
+    return recall, precision, mean_dist
+
+
+def loadWorkspace(work_dir, limit=None):
+    """Yield (img_name, color image) and the template of a workspace."""
+    from .infoCollector import InfoCollector
+
+    info_c = InfoCollector(work_dir)
+    t = cv2.imdecode(np.fromfile(info_c.P_TEMPLATE, dtype=np.uint8), cv2.IMREAD_GRAYSCALE)
+    img_names = info_c.getImageNames()[:limit]
+
+    def images():
+        for img_name in img_names:
+            img_path = info_c.P_IMAGE.format(img_name=img_name)
+            yield img_name, cv2.imdecode(
+                np.fromfile(img_path, dtype=np.uint8), cv2.IMREAD_COLOR
+            )
+
+    return images(), t
+
+
+def findPeaksLoop(result, t_shape, match_thre):
+    """The original minMaxLoc / rectangle loop, kept as the reference."""
+    result = result.copy()
+    wells_loc = []
+    while True:
+        minVal, maxVal, minLoc, maxLoc = cv2.minMaxLoc(result)
+        if maxVal < match_thre:
+            break
+
+        wells_loc.append(maxLoc)
+        t_h, t_w = t_shape[::-1]
+
+        p1 = (maxLoc[0] - t_w // 2, maxLoc[1] - t_h // 2)
+        p2 = (maxLoc[0] + t_w // 2, maxLoc[1] + t_h // 2)
+        cv2.rectangle(result, p1, p2, 0, thickness=cv2.FILLED)
+    return wells_loc
+
+
+def timeit(func, *args, repeat=3):
+    best = float("inf")
+    out = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        out = func(*args)
+        best = min(best, time.perf_counter() - start)
+    return best, out
+
+
+def benchPeaks():
+    """Loop vs vectorized peak finding, for growing well counts."""
+    print(f"{'wells':>7} {'loop ms':>10} {'vector ms':>10} {'speedup':>8} same")
+    for side in [10, 20, 30, 45, 60]:
+        src_color, t = syntheticPlate(side, side)
+        result = responseMap(src_color, t)
+        t_loop, ref = timeit(findPeaksLoop, result, t.shape, 0.15, repeat=1)
+        t_vec, out = timeit(findPeaks, result, t.shape, 0.15)
+        print(
+            f"{len(ref):>7} {t_loop * 1e3:>10.1f} {t_vec * 1e3:>10.1f} "
+            f"{t_loop / t_vec:>7.1f}x {out == ref}"
+        )
+
+
+def benchPyramid(work_dir=None, limit=10):
+    """
+    Accuracy and speed of pyramid matching against the exhaustive path.
+
+    Runs on synthetic plates of 45x45 wells with a growing pitch, or on the
+    first images of a workspace when work_dir is given. Recall is reported
+    for all exhaustive wells and for the strong ones (score >= 0.5).
+    """
+    if work_dir:
+        images, t = loadWorkspace(work_dir, int(limit))
+    else:
+        _, t = syntheticPlate(1, 1)
+
+        def synthetic():
+            for pitch in [40, 70, 100, 140]:
+                src_color, _ = syntheticPlate(45, 45, pitch=pitch, seed=pitch)
+                yield f"synthetic pitch {pitch}", src_color
+
+        images = synthetic()
+
+    print(
+        f"{'image':>22} {'MPix':>5} {'wells':>6} {'strong':>6} {'exh ms':>8} "
+        f"{'pyr ms':>8} {'speedup':>8} {'rec all':>7} {'rec str':>7} {'prec':>6}"
+    )
+    for img_name, src_color in images:
+        img_binary = binarize(src_color)
+
+        def exhaustive():
+            result = cv2.matchTemplate(img_binary, t, cv2.TM_CCOEFF_NORMED)
+            return findPeaks(result, t.shape, 0.15, return_values=True)
+
+        t_exh, (ref, vals) = timeit(exhaustive, repeat=1)
+        t_pyr, out = timeit(pyramidPeaks, img_binary, t, 0.15, repeat=1)
+        strong = [loc for loc, val in zip(ref, vals) if val >= 0.5]
+        recall, precision, _ = matchWells(ref, out)
+        recall_strong, _, _ = matchWells(strong, out)
+        print(
+            f"{os.path.basename(img_name)[-22:]:>22} {img_binary.size / 1e6:>5.1f} "
+            f"{len(ref):>6} {len(strong):>6} {t_exh * 1e3:>8.0f} {t_pyr * 1e3:>8.0f} "
+            f"{t_exh / t_pyr:>7.1f}x {recall:>7.3f} {recall_strong:>7.3f} "
+            f"{precision:>6.3f}"
+        )
+
+
+def benchGrid():
+    """Lattice-fit grid extraction against the exhaustive path."""
+    print(
+        f"{'angle':>6} {'pitch':>6} {'MPix':>5} {'strong':>6} {'exh ms':>8} "
+        f"{'grid ms':>8} {'speedup':>8} {'recall':>7} {'prec':>6} {'rows x cols':>12}"
+    )
+    for angle, pitch in [(0, 40), (3, 70), (-7, 100), (20, 140)]:
+        src_color, t = syntheticPlate(45, 45, pitch=pitch, angle=angle, seed=pitch)
+        img_binary = binarize(src_color)
+
+        def exhaustive():
+            result = cv2.matchTemplate(img_binary, t, cv2.TM_CCOEFF_NORMED)
+            return findPeaks(result, t.shape, 0.15, return_values=True)
+
+        t_exh, (ref, vals) = timeit(exhaustive, repeat=1)
+        t_grid, out = timeit(latticePeaks, img_binary, t, 0.15, repeat=1)
+        strong = [loc for loc, val in zip(ref, vals) if val >= 0.5]
+        recall, precision, _ = matchWells(strong, out)
+        rows = max(loc[2] for loc in out) + 1
+        cols = max(loc[3] for loc in out) + 1
+        print(
+            f"{angle:>6} {pitch:>6} {img_binary.size / 1e6:>5.1f} {len(strong):>6} "
+            f"{t_exh * 1e3:>8.0f} {t_grid * 1e3:>8.0f} {t_exh / t_grid:>7.1f}x "
+            f"{recall:>7.3f} {precision:>6.3f} {f'{rows} x {cols}':>12}"
+        )
+
+
+def getWellsTensorLoop(img, wells_loc):
+    """The original per-well crop loop, kept as the reference."""
+    import torch
+    from torchvision import transforms
+
+    well_tensors = []
+    for loc in wells_loc:
+        x, y, w, h = loc
+        well = img[y : y + h, x : x + w]
+        well = cv2.resize(well, (32, 32))
+        well_tensor = torch.from_numpy(well).permute(2, 0, 1).unsqueeze(0).float()
+        well_tensor = well_tensor / 255.0
+        norm = transforms.Normalize(mean=[0.5, 0.5, 0.5], std=[0.5, 0.5, 0.5])
+        well_tensor = norm(well_tensor)
+        well_tensors.append(well_tensor)
+    return torch.cat(well_tensors, dim=0)
+
+
+def benchCrops():
+    """Per-well loop vs batched crops, for 100 to 10,000 wells per image."""
+    from .algorithm import getWellsTensor
+
+    print(f"{'wells':>7} {'loop ms':>10} {'batch ms':>10} {'speedup':>8} same")
+    for side in [10, 32, 55, 100]:
+        src_color, t = syntheticPlate(side, side)
+        t_h, t_w = t.shape
+        wells_loc = [
+            (x - t_w // 2, y - t_h // 2, t_w, t_h)
+            for x in range(40 + 20, 40 + side * 40, 40)
+            for y in range(40 + 20, 40 + side * 40, 40)
+        ]
+        t_loop, ref = timeit(getWellsTensorLoop, src_color, wells_loc)
+        t_batch, out = timeit(getWellsTensor, src_color, wells_loc)
+        print(
+            f"{len(wells_loc):>7} {t_loop * 1e3:>10.1f} {t_batch * 1e3:>10.1f} "
+            f"{t_loop / t_batch:>7.1f}x {bool((out == ref).all())}"
+        )
+
+
+def benchBatching(model_name="mobilenet", total=8192):
+    """
+    Wells per second of per-image batches against fixed-size batches, for
+    the same wells spread over a growing number of images.
+    """
+    import torch
+    from . import _nets
+    from ._inference import WellBatcher, autoBatchSize
+    from .algorithm import normalizeWells, classifyBatch
+
+    nets = {"mobilenet": _nets.MobileNet, "resnet18": _nets.Resnet18, "resnet50": _nets.Resnet50}
+    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    model = nets[model_name](3).to(device).eval()
+    batch_size = autoBatchSize(model, device, 1024)
+    total = int(total)
+    rng = np.random.default_rng(0)
+    crops = rng.integers(0, 256, (total, 32, 32, 3), dtype=np.uint8)
+
+    def perImage(images):
+        for image in images:
+            with torch.no_grad():
+                model(normalizeWells(image).to(device)).argmax(1).cpu()
+
+    def streamed(images):
+        batcher = WellBatcher(batch_size)
+        for idx, image in enumerate(images):
+            batcher.add(idx, [None] * len(image), image)
+            while batcher.isFull():
+                classifyBatch(model, batcher, device)
+            batcher.popFinished()
+        while not batcher.isEmpty():
+            classifyBatch(model, batcher, device)
+        batcher.popFinished()
+
+    print(f"{model_name} on {device}, auto batch size {batch_size}")
+    print(f"{'images':>7} {'wells/img':>10} {'per-image w/s':>14} {'batched w/s':>12}")
+    for num_images in [1, 8, 64, 512, 4096]:
+        images = np.array_split(crops, num_images)
+        t_img, _ = timeit(perImage, images, repeat=1)
+        t_batch, _ = timeit(streamed, images, repeat=1)
+        print(
+            f"{num_images:>7} {total // num_images:>10} {total / t_img:>14.0f} "
+            f"{total / t_batch:>12.0f}"
+        )
+
+
+def plateWorkspace(work_dir, num_images, pitch=100):
+    """A workspace of extracted synthetic plates and an untrained model."""
+    import torch
+    from ._nets import MobileNet
+    from .infoCollector import InfoCollector
+    from .algorithm import writeExtracted
+
+    src_color, t = syntheticPlate(45, 45, pitch=pitch)
+    img_names = [f"plate{i}.jpg" for i in range(num_images)]
+    for img_name in img_names:
+        cv2.imwrite(os.path.join(work_dir, img_name), src_color)
+    info_c = InfoCollector(work_dir)
+
+    # wells at the drawn positions, top-left corners
+    t_h, t_w = t.shape
+    centers = range(pitch + pitch // 2, pitch + 45 * pitch, pitch)
+    wells_loc = [(x - t_w // 2, y - t_h // 2) for y in centers for x in centers]
+    for img_name in img_names:
+        writeExtracted(info_c, img_name, wells_loc, t.shape)
+    model_path = os.path.join(work_dir, "model.pth")
+    torch.save(MobileNet(3), model_path)
+
+    print(
+        f"{num_images} images of {src_color.shape[1]}x{src_color.shape[0]}, "
+        f"{len(wells_loc)} wells each"
+    )
+    return info_c, img_names, model_path, len(wells_loc) * num_images
+
+
+def benchPrefetch(num_images=16, num_workers=2, prefetch=4):
+    """
+    Per-stage time of classification without and with decode workers, on a
+    temporary workspace of large plates. With workers, decode + crop +
+    infer add up to more than the total once the stages overlap.
+    """
+    from .algorithm import ClassifyThread
+
+    num_images, num_workers, prefetch = int(num_images), int(num_workers), int(prefetch)
+    with tempfile.TemporaryDirectory() as work_dir:
+        info_c, img_names, model_path, _ = plateWorkspace(work_dir, num_images)
+        for workers in [0, num_workers]:
+            thread = ClassifyThread(
+                info_c, model_path, img_names, num_workers=workers, prefetch=prefetch
+            )
+            thread.run()
+            print(f"workers {workers}: {thread.timingReport()}")
+
+
+def benchShards(num_images=32, cpu_mode="fp32"):
+    """Throughput of sharded CPU classification from 1 to all cores."""
+    from .algorithm import ClassifyThread
+
+    num_images = int(num_images)
+    num_cores = len(os.sched_getaffinity(0)) if hasattr(os, "sched_getaffinity") else os.cpu_count()
+    counts = sorted({1, num_cores} | {2**i for i in range(1, 7) if 2**i < num_cores})
+    with tempfile.TemporaryDirectory() as work_dir:
+        info_c, img_names, model_path, num_wells = plateWorkspace(work_dir, num_images)
+        print(f"{num_cores} cores, CPU mode {cpu_mode}")
+        print(f"{'processes':>9} {'time s':>8} {'wells/s':>9} {'speedup':>8}")
+        base = None
+        for num_shards in [0] + counts:
+            thread = ClassifyThread(
+                info_c, model_path, img_names, cpu_mode=cpu_mode, num_shards=num_shards
+            )
+            start = time.perf_counter()
+            thread.run()
+            elapsed = time.perf_counter() - start
+            base = base or elapsed
+            label = "single" if num_shards == 0 else num_shards
+            print(
+                f"{label:>9} {elapsed:>8.1f} {num_wells / elapsed:>9.0f} "
+                f"{base / elapsed:>7.1f}x"
+            )
+
+
+def benchOptimize(model_path=None, work_dir=None):
+    """
+    Accuracy and speed of the optimized CPU modes against fp32.
+
+    With a model and a workspace, uses the workspace's edited wells. Without,
+    compares untrained nets on random wells labelled by their fp32 output, so
+    accuracy equals agreement.
+    """
+    import torch
+    from . import _nets
+    from ._optimize import CPU_MODES, convertModel, compareModels
+    from ._checkpoint import readModel
+    from .algorithm import normalizeWells, editedWells
+
+    torch.manual_seed(0)
+    if model_path:
+        from .infoCollector import InfoCollector
+
+        crops, labels = editedWells(InfoCollector(work_dir))
+        models = {os.path.basename(model_path): readModel(model_path)}
+    else:
+        rng = np.random.default_rng(0)
+        crops = rng.integers(0, 256, (2048, 32, 32, 3), dtype=np.uint8)
+        labels = None
+        models = {
+            "mobilenet": _nets.MobileNet(3),
+            "resnet18": _nets.Resnet18(3),
+            "resnet50": _nets.Resnet50(3),
+        }
+    wells_tensor = normalizeWells(crops)
+
+    print(f"{len(wells_tensor)} wells, {torch.get_num_threads()} threads")
+    print(
+        f"{'model':>12} {'mode':>13} {'convert s':>10} {'ms/1k':>8} {'speedup':>8} "
+        f"{'accuracy':>9} {'delta':>7} {'agree':>7}"
+    )
+    for name, model in models.items():
+        model = model.cpu().eval()
+        model_labels = labels
+        if model_labels is None:
+            with torch.no_grad():
+                model_labels = model(wells_tensor).argmax(1).numpy()
+        for mode in CPU_MODES[1:]:
+            start = time.perf_counter()
+            optimized = convertModel(model, mode, wells_tensor.split(64))
+            elapsed = time.perf_counter() - start
+            report = compareModels(model, optimized, wells_tensor, model_labels)
+            print(
+                f"{name[-12:]:>12} {mode:>13} {elapsed:>10.1f} {report['ms_per_1k']:>8.0f} "
+                f"{report['fp32_ms_per_1k'] / report['ms_per_1k']:>7.1f}x "
+                f"{report['accuracy'] * 100:>8.2f}% "
+                f"{(report['accuracy'] - report['fp32_accuracy']) * 100:>+7.2f} "
+                f"{report['agreement'] * 100:>6.2f}%"
+            )
+
+
+def referenceDataset(well_imgs, class_idxs):
+    """The original per-item ToTensor / Resize / Normalize dataset, as reference."""
+    import torch
+    from torch.utils.data import Dataset
+    from torchvision import transforms
+
+    class WellDatasetReference(Dataset):
+        def __init__(self):
+            self.transforms = transforms.Compose(
+                [
+                    transforms.ToTensor(),
+                    transforms.Resize([32, 32]),
+                    transforms.Normalize((0.5, 0.5, 0.5), (0.5, 0.5, 0.5)),
+                    transforms.RandomHorizontalFlip(),
+                    transforms.RandomVerticalFlip(),
+                    transforms.RandomRotation(180),
+                    transforms.RandomAffine(0, shear=10, scale=(0.8, 1.2)),
+                ]
+            )
+
+        def __len__(self):
+            return len(class_idxs)
+
+        def __getitem__(self, idx):
+            img = self.transforms(well_imgs[idx] / 255.0)
+            label = torch.tensor(class_idxs[idx]).to(torch.float32)
+            return img.to(torch.float32), label
+
+    return WellDatasetReference()
+
+
+def plateWells(num_wells, radius=12):
+    """Full-size well crops cut from a synthetic plate."""
+    side = int(np.ceil(num_wells**0.5))
+    pitch = 3 * radius + 4
+    src_color, t = syntheticPlate(side, side, pitch=pitch, radius=radius)
+    t_h, t_w = t.shape
+    centers = range(pitch + pitch // 2, pitch + side * pitch, pitch)
+    return [
+        src_color[y - t_h // 2 : y - t_h // 2 + t_h, x - t_w // 2 : x - t_w // 2 + t_w]
+        for y in centers
+        for x in centers
+    ][:num_wells]
+
+
+def benchDataset(num_wells=4096, batch_size=64, radius=12):
+    """Epoch time of the original dataset against the packed uint8 one."""
+    import torch
+    from ._nets import WellDataset
+
+    num_wells, batch_size, radius = int(num_wells), int(batch_size), int(radius)
+    well_imgs = plateWells(num_wells, radius)
+    class_idxs = [i % 3 for i in range(len(well_imgs))]
+
+    def epoch(dataset):
+        loader = torch.utils.data.DataLoader(dataset, batch_size=batch_size, shuffle=True)
+        for inputs, labels in loader:
+            pass
+        return inputs.dtype, labels.dtype
+
+    t_build, dataset = timeit(WellDataset, well_imgs, class_idxs, repeat=1)
+    t_ref, ref_types = timeit(epoch, referenceDataset(well_imgs, class_idxs), repeat=1)
+    t_new, new_types = timeit(epoch, dataset, repeat=1)
+    size = well_imgs[0].shape[0]
+    print(f"{len(well_imgs)} wells of {size}x{size}, batch {batch_size}")
+    print(f"{'dataset':>9} {'build s':>8} {'epoch s':>8} {'samples/s':>10} {'inputs':>14} {'labels':>12}")
+    print(
+        f"{'original':>9} {0:>8.2f} {t_ref:>8.2f} {len(well_imgs) / t_ref:>10.0f} "
+        f"{str(ref_types[0]):>14} {str(ref_types[1]):>12}"
+    )
+    print(
+        f"{'packed':>9} {t_build:>8.2f} {t_new:>8.2f} {len(well_imgs) / t_new:>10.0f} "
+        f"{str(new_types[0]):>14} {str(new_types[1]):>12}"
+    )
+    print(f"epoch speedup {t_ref / t_new:.1f}x")
+
+
+def benchAugment(num_wells=4096, batch_size=64):
+    """Samples per second of per-sample against batched augmentation."""
+    import torch
+    from ._nets import WellDataset, BatchAugment
+
+    num_wells, batch_size = int(num_wells), int(batch_size)
+    well_imgs = plateWells(num_wells)
+    class_idxs = [i % 3 for i in range(len(well_imgs))]
+    devices = [torch.device("cpu")]
+    if torch.cuda.is_available():
+        devices.append(torch.device("cuda"))
+
+    def epoch(dataset, device, augment=None):
+        loader = torch.utils.data.DataLoader(dataset, batch_size=batch_size, shuffle=True)
+        for inputs, labels in loader:
+            inputs = inputs.to(device)
+            if augment is not None:
+                inputs = augment(inputs)
+        if device.type == "cuda":
+            torch.cuda.synchronize()
+
+    print(f"{len(well_imgs)} wells, batch {batch_size}")
+    print(f"{'pipeline':>22} {'device':>7} {'samples/s':>10} {'speedup':>8}")
+    t_ref, _ = timeit(epoch, referenceDataset(well_imgs, class_idxs), devices[0], repeat=1)
+    print(f"{'original':>22} {'cpu':>7} {len(well_imgs) / t_ref:>10.0f} {1:>7.1f}x")
+    for device in devices:
+        pipelines = [
+            ("packed, per sample", WellDataset(well_imgs, class_idxs), None),
+            ("packed, batched", WellDataset(well_imgs, class_idxs, False), BatchAugment()),
+        ]
+        for name, dataset, augment in pipelines:
+            t, _ = timeit(epoch, dataset, device, augment, repeat=1)
+            print(
+                f"{name:>22} {device.type:>7} {len(well_imgs) / t:>10.0f} "
+                f"{t_ref / t:>7.1f}x"
+            )
+
+
+def _datasetPeakRss(work_dir, mode):
+    # runs in a fresh process, so the peak belongs to this dataset build
+    from .infoCollector import InfoCollector
+    from .algorithm import TrainThread
+
+    info_c = InfoCollector(work_dir)
+    resetPeakRss()
+    start = time.perf_counter()
+    if mode == "original":
+        # crops sliced out of the decoded images, each one keeps its image alive
+        well_imgs = []
+        for img_name in info_c.getImageNamesByFilter(([True, False], [True, False], [True])):
+            img_path = info_c.P_IMAGE.format(img_name=img_name)
+            img = cv2.imdecode(np.fromfile(img_path, dtype=np.uint8), cv2.IMREAD_COLOR)
+            with open(info_c.P_EDIT.format(img_name=img_name), "r") as f:
+                for line in f.readlines():
+                    x, y, w, h, label = map(int, line.split(","))
+                    well_imgs.append(img[y : y + h, x : x + w])
+        num_wells = len(well_imgs)
+    else:
+        thread = TrainThread(info_c, "", "MobileNet", 1, 64, lazy_dataset=mode == "lazy")
+        train_set, val_set = thread.getDataset()
+        num_wells = len(train_set) + (len(val_set) if val_set is not None else 0)
+    return num_wells, time.perf_counter() - start, peakRssMb()
+
+
+def editedWorkspace(work_dir, num_images, pitch=100):
+    """
+    A plateWorkspace whose wells are all edited, into three classes that
+    can be told apart: empty, gray-filled and dark-filled.
+    """
+    from .infoCollector import InfoCollector
+    from ._crops import readWellsLoc
+
+    info_c, img_names, model_path, num_wells = plateWorkspace(work_dir, num_images, pitch)
+    with open(info_c.P_CLASS, "w") as f:
+        f.write("empty\nsingle\nmultiple\n")
+    rng = np.random.default_rng(0)
+    for img_name in img_names:
+        img_path = info_c.P_IMAGE.format(img_name=img_name)
+        img = cv2.imread(img_path)
+        rects = readWellsLoc(info_c.P_EXTARCT.format(img_name=img_name))
+        labels = rng.integers(0, 3, len(rects))
+        with open(info_c.P_EDIT.format(img_name=img_name), "w") as f:
+            for (x, y, w, h), label in zip(rects, labels):
+                if label:
+                    center = (int(x + w // 2), int(y + h // 2))
+                    cv2.circle(img, center, w // 2 - 6, (140 if label == 1 else 60,) * 3, -1)
+                f.write(f"{x},{y},{w},{h},{label}\n")
+        cv2.imwrite(img_path, img)
+    return InfoCollector(work_dir), img_names, model_path, num_wells
+
+
+def benchTrainData(num_images=16, pitch=100):
+    """Peak memory and build time of the training dataset, per build mode."""
+    num_images, pitch = int(num_images), int(pitch)
+    ctx = multiprocessing.get_context("spawn")
+    with tempfile.TemporaryDirectory() as work_dir:
+        editedWorkspace(work_dir, num_images, pitch)
+
+        print(f"{'dataset':>13} {'wells':>7} {'build s':>8} {'peak MB':>8}")
+        # the first packed build fills the well store, the later ones read it
+        for name, mode in [
+            ("original", "original"),
+            ("packed cold", "packed"),
+            ("packed warm", "packed"),
+            ("lazy warm", "lazy"),
+        ]:
+            with ctx.Pool(1) as pool:
+                num_wells, elapsed, rss = pool.apply(_datasetPeakRss, (work_dir, mode))
+            print(f"{name:>13} {num_wells:>7} {elapsed:>8.2f} {rss:>8.0f}")
+
+
+def benchPrecision(num_images=3, epochs=2, model_type="Resnet18"):
+    """
+    Training and classification speed, and accuracy, per precision.
+
+    MobileNet is not the default, on these uniform synthetic wells its
+    batch norm statistics collapse in eval mode and it scores chance.
+    """
+    import io
+    import contextlib
+    import torch
+    from ._inference import PRECISIONS
+    from .algorithm import TrainThread, ClassifyThread
+
+    num_images, epochs = int(num_images), int(epochs)
+    with tempfile.TemporaryDirectory() as work_dir:
+        info_c, img_names, _, num_wells = editedWorkspace(work_dir, num_images)
+        print(f"{torch.get_num_threads()} threads, cpu {torch.backends.cpu.get_cpu_capability()}")
+        print(
+            f"{'precision':>9} {'train/s':>8} {'val acc':>8} {'classify/s':>11} "
+            f"{'agree':>7}"
+        )
+        ref_predicted = None
+        for precision in PRECISIONS:
+            if precision == "fp16" and not torch.cuda.is_available():
+                continue
+            torch.manual_seed(0)
+            thread = TrainThread(
+                info_c, "", model_type, epochs, 64, num_workers=0, val_percent=34,
+                patience=0, precision=precision,
+            )
+            # same seed and split, the runs differ only by precision
+            with contextlib.redirect_stdout(io.StringIO()):
+                thread.run()
+            train_rate = (
+                thread.dataset_report["wells"] * epochs / thread.loader_report["compute_s"]
+            )
+            model_path = info_c.P_MODEL.format(model_type=model_type, time=thread.time_str)
+
+            classify = ClassifyThread(
+                info_c, model_path, img_names, batch_size=256, precision=precision
+            )
+            classify.run()
+            predicted = np.concatenate(
+                [np.array(info_c.getClassified(name))[:, 4] for name in img_names]
+            )
+            ref_predicted = predicted if ref_predicted is None else ref_predicted
+            print(
+                f"{precision:>9} {train_rate:>8.0f} "
+                f"{thread.train_report['val_accuracy'] * 100:>7.2f}% "
+                f"{num_wells / classify.timing['infer']:>11.0f} "
+                f"{(predicted == ref_predicted).mean() * 100:>6.2f}%"
+            )
+            time.sleep(1)  # model files are named by the second
+
+
+def benchDdp(num_images=4, max_processes=None, epochs=1):
+    """
+    Training throughput of data-parallel MobileNet, from 1 process to
+    max_processes, and the scaling efficiency against one process.
+    """
+    import io
+    import contextlib
+    import torch
+    from .algorithm import TrainThread
+
+    num_images, epochs = int(num_images), int(epochs)
+    max_processes = int(max_processes or os.cpu_count() or 1)
+    counts = sorted({1, max_processes} | {2**i for i in range(1, 8) if 2**i < max_processes})
+    with tempfile.TemporaryDirectory() as work_dir:
+        info_c, _, _, _ = editedWorkspace(work_dir, num_images)
+        print(f"{os.cpu_count()} cores, batch 64 per process, {epochs} epochs")
+        print(f"{'processes':>9} {'wells/s':>8} {'speedup':>8} {'efficiency':>11}")
+        base_rate = None
+        for num_processes in counts:
+            torch.manual_seed(0)
+            thread = TrainThread(
+                info_c, "", "MobileNet", epochs, 64, num_workers=0, val_percent=0,
+                num_processes=num_processes,
+            )
+            with contextlib.redirect_stdout(io.StringIO()):
+                thread.run()
+            report = thread.loader_report
+            rate = report["wells"] / (report["data_s"] + report["compute_s"])
+            base_rate = base_rate or rate
+            print(
+                f"{num_processes:>9} {rate:>8.0f} {rate / base_rate:>7.2f}x "
+                f"{rate / base_rate / num_processes * 100:>10.0f}%"
+            )
+            time.sleep(1)  # model files are named by the second
+
+
+def countMacs(model, size=32):
+    """Multiply-accumulates of the convolutions and linear layers for one well."""
+    import torch
+
+    total = 0
+
+    def hook(module, inputs, output):
+        nonlocal total
+        if isinstance(module, torch.nn.Conv2d):
+            kernel = module.kernel_size[0] * module.kernel_size[1]
+            total += output.numel() * module.in_channels // module.groups * kernel
+        else:
+            total += output.numel() * module.in_features
+
+    layers = [m for m in model.modules() if isinstance(m, (torch.nn.Conv2d, torch.nn.Linear))]
+    handles = [m.register_forward_hook(hook) for m in layers]
+    try:
+        with torch.no_grad():
+            model.eval()(torch.zeros(1, 3, size, size))
+    finally:
+        for handle in handles:
+            handle.remove()
+    return total
+
+
+def copyEdited(work_dir, copy_dir, num_images):
+    """The first num_images edited images of a workspace, with their edits, in copy_dir."""
+    from .infoCollector import InfoCollector
+
+    info_c = InfoCollector(work_dir)
+    img_names = info_c.getImageNamesByFilter(([True, False], [True, False], [True]))
+    copy_c = InfoCollector(copy_dir)
+    for attr in ["P_CLASS", "P_METADATA"]:
+        if os.path.exists(getattr(info_c, attr)):
+            shutil.copy2(getattr(info_c, attr), getattr(copy_c, attr))
+    for img_name in img_names[:num_images]:
+        for attr in ["P_IMAGE", "P_EDIT"]:
+            path = getattr(info_c, attr).format(img_name=img_name)
+            shutil.copy2(path, getattr(copy_c, attr).format(img_name=img_name))
+    return InfoCollector(copy_dir)
+
+
+def benchModels(num_images=3, epochs=3, model_types="", work_dir=None):
+    """
+    Parameters, FLOPs, CPU latency per 1,000 wells and validation accuracy
+    of every model type, trained the same epochs on the same edited wells.
+    model_types is a comma-separated subset of the MODELS names.
+
+    With a workspace, uses the edited wells of its first num_images edited
+    images, copied so that no models are saved there. Without, a synthetic
+    editedWorkspace.
+    """
+    import io
+    import contextlib
+    import torch
+    from ._nets import MODELS
+    from ._checkpoint import readModel
+    from .algorithm import TrainThread, normalizeWells, editedWells
+
+    num_images, epochs = int(num_images), int(epochs)
+    model_types = model_types.split(",") if model_types else list(MODELS)
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        if work_dir:
+            info_c = copyEdited(work_dir, tmp_dir, num_images)
+        else:
+            info_c, _, _, _ = editedWorkspace(tmp_dir, num_images)
+        crops, _ = editedWells(info_c, limit=1000)
+        if not len(crops):
+            print("No edited wells.")
+            return
+        wells = normalizeWells(crops)
+        wells = wells.repeat(-(-1000 // len(wells)), 1, 1, 1)[:1000]
+
+        print(f"{torch.get_num_threads()} threads, {epochs} epochs, batch 64, latency batch 256")
+        print(
+            f"{'model':>10} {'params':>8} {'MFLOPs':>8} {'ms/1k':>8} {'train s':>8} "
+            f"{'val acc':>8}"
+        )
+        for model_type in model_types:
+            torch.manual_seed(0)
+            thread = TrainThread(
+                info_c, "", model_type, epochs, 64, num_workers=0, val_percent=34,
+                patience=0,
+            )
+            # same seed and split, the runs differ only by model
+            start = time.perf_counter()
+            with contextlib.redirect_stdout(io.StringIO()):
+                thread.run()
+            train_s = time.perf_counter() - start
+
+            model_path = info_c.P_MODEL.format(model_type=model_type, time=thread.time_str)
+            model = readModel(model_path, map_location="cpu").eval()
+            num_params = sum(p.numel() for p in model.parameters())
+            flops = 2 * countMacs(model)
+
+            def predict():
+                with torch.no_grad():
+                    for batch in wells.split(256):
+                        model(batch).argmax(1)
+
+            elapsed, _ = timeit(predict)
+            print(
+                f"{model_type:>10} {num_params / 1e6:>7.2f}M {flops / 1e6:>8.1f} "
+                f"{elapsed * 1000:>8.1f} {train_s:>8.1f} "
+                f"{thread.train_report['best_accuracy'] * 100:>7.2f}%"
+            )
+            time.sleep(1)  # model files are named by the second
+
+
+def _extractPeakRss(img_path, t, memory_mb):
+    # runs in a fresh process, so the peak belongs to this extraction
+    start = time.perf_counter()
+    if memory_mb > 0:
+        wells_loc = tiledPeaks(GrayImage(img_path), t, 0.15, 25, 10, memory_mb)
+    else:
+        src_color = cv2.imdecode(np.fromfile(img_path, dtype=np.uint8), cv2.IMREAD_COLOR)
+        result = cv2.matchTemplate(binarize(src_color), t, cv2.TM_CCOEFF_NORMED)
+        wells_loc = findPeaks(result, t.shape, 0.15)
+    elapsed = time.perf_counter() - start
+    return wells_loc, elapsed, peakRssMb()
+
+
+def benchTiled(memory_mb=256, pitch=140):
+    """Peak memory, time and agreement of tiled against untiled extraction."""
+    memory_mb, pitch = int(memory_mb), int(pitch)
+    src_color, t = syntheticPlate(45, 45, pitch=pitch)
+    ctx = multiprocessing.get_context("spawn")
+    print(f"image {src_color.shape[1]}x{src_color.shape[0]}, budget {memory_mb} MB")
+    print(
+        f"{'format':>6} {'path':>8} {'peak MB':>8} {'time ms':>8} {'wells':>6} "
+        f"{'same':>6} {'recall':>7} {'prec':>6}"
+    )
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for ext in ["bmp", "jpg"]:
+            img_path = os.path.join(tmp_dir, f"plate.{ext}")
+            cv2.imwrite(img_path, src_color)
+            ref = None
+            for name, budget in [("untiled", 0), ("tiled", memory_mb)]:
+                with ctx.Pool(1) as pool:
+                    wells_loc, elapsed, rss = pool.apply(
+                        _extractPeakRss, (img_path, t, budget)
+                    )
+                if ref is None:
+                    ref = wells_loc
+                recall, precision, _ = matchWells(ref, wells_loc, tol=0)
+                print(
+                    f"{ext:>6} {name:>8} {rss:>8.0f} {elapsed * 1e3:>8.0f} "
+                    f"{len(wells_loc):>6} {str(wells_loc == ref):>6} "
+                    f"{recall:>7.3f} {precision:>6.3f}"
+                )
+
+
+BENCHMARKS = {
+    "peaks": benchPeaks,
+    "pyramid": benchPyramid,
+    "grid": benchGrid,
+    "tiled": benchTiled,
+    "crops": benchCrops,
+    "batching": benchBatching,
+    "prefetch": benchPrefetch,
+    "optimize": benchOptimize,
+    "shards": benchShards,
+    "dataset": benchDataset,
+    "augment": benchAugment,
+    "traindata": benchTrainData,
+    "precision": benchPrecision,
+    "ddp": benchDdp,
+    "models": benchModels,
+}
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2 or sys.argv[1] not in BENCHMARKS:
+        print(f"Usage: python -m AIMWR.benchmark [{'|'.join(BENCHMARKS)}] [args]")
+        sys.exit(1)
+    BENCHMARKS[sys.argv[1]](*sys.argv[2:])
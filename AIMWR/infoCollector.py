@@ -1,4 +1,5 @@
 import os
+import json
 
 
 class InfoCollector:
@@ -13,15 +14,25 @@ class InfoCollector:
         self.P_EXTARCT = os.path.join(self.P_DIR, "extraction/{img_name}.txt")
         self.P_CLASSIFY = os.path.join(self.P_DIR, "classification/{img_name}.txt")
         self.P_EDIT = os.path.join(self.P_DIR, "edit/{img_name}.txt")
+        self.P_GRID = os.path.join(self.P_DIR, "grid/{img_name}.txt")
+        self.P_FINGERPRINT = os.path.join(self.P_DIR, "fingerprint/{img_name}.json")
         self.P_MODEL = os.path.join(self.P_DIR, "model/{model_type}_{time}.pth")
+        self.P_CHECKPOINT = os.path.join(
+            self.P_DIR, "checkpoint/{model_type}_{time}_epoch{epoch:04d}.ckpt"
+        )
+        self.P_CACHE = os.path.join(self.P_DIR, "cache")
+        self.P_WELLS = os.path.join(self.P_DIR, "wells")
+        self.P_FEATURES = os.path.join(self.P_DIR, "features")
 
         self.class_names: list[str] = []
+        self.metadata: dict = {}  # workspace settings, saved in metadata.json
         self.img_name_current: str = ""
         self.img_status: dict[str, tuple[bool, bool, bool]] = {}
         # {"img_name": (extracted, classified, edited), ...}
 
         self._makeDirsFiles()
         self._loadClass()
+        self._loadMetadata()
         self.renewStatus()
 
         self.classes_show = [-1] + [
@@ -41,9 +52,18 @@ class InfoCollector:
         if not os.path.exists(os.path.join(self.P_DIR, "edit")):
             os.makedirs(os.path.join(self.P_DIR, "edit"))
 
+        if not os.path.exists(os.path.join(self.P_DIR, "grid")):
+            os.makedirs(os.path.join(self.P_DIR, "grid"))
+
+        if not os.path.exists(os.path.join(self.P_DIR, "fingerprint")):
+            os.makedirs(os.path.join(self.P_DIR, "fingerprint"))
+
         if not os.path.exists(os.path.join(self.P_DIR, "model")):
             os.makedirs(os.path.join(self.P_DIR, "model"))
 
+        if not os.path.exists(os.path.join(self.P_DIR, "checkpoint")):
+            os.makedirs(os.path.join(self.P_DIR, "checkpoint"))
+
         if not os.path.exists(self.P_CLASS):
             with open(self.P_CLASS, "w") as f:
                 f.write("")
@@ -54,6 +74,20 @@ class InfoCollector:
         class_names = [name.strip() for name in class_names]
         self.class_names = class_names
 
+    def _loadMetadata(self):
+        if not os.path.exists(self.P_METADATA):
+            return
+        with open(self.P_METADATA, "r") as f:
+            self.metadata = json.load(f)
+
+    def getSetting(self, key: str, default=None):
+        return self.metadata.get(key, default)
+
+    def setSetting(self, key: str, value):
+        self.metadata[key] = value
+        with open(self.P_METADATA, "w") as f:
+            json.dump(self.metadata, f, indent=4)
+
     def renewStatus(self):
         image_names = self.getImageNames()
         for img_name in image_names:
@@ -111,6 +145,18 @@ class InfoCollector:
     def getEdit(self, img_name: str):
         return self._getResults(img_name, self.P_EDIT)
 
+    def getFingerprint(self, img_name: str):
+        # inputs of the last extraction: image size, mtime, digest and params
+        path = self.P_FINGERPRINT.format(img_name=img_name)
+        if not os.path.exists(path):
+            return None
+        with open(path, "r") as f:
+            return json.load(f)
+
+    def setFingerprint(self, img_name: str, fingerprint: dict):
+        with open(self.P_FINGERPRINT.format(img_name=img_name), "w") as f:
+            json.dump(fingerprint, f)
+
     def _getResults(self, img_name: str, path: str):
         if not os.path.exists(path.format(img_name=img_name)):
             return []
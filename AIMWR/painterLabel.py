@@ -3,6 +3,7 @@ from PySide6.QtWidgets import QLabel, QWidget, QGraphicsOpacityEffect
 from PySide6.QtCore import Qt, QPoint, Signal, QRect, QPoint
 from PySide6.QtGui import QMouseEvent, QPainter, QPen, QPixmap
 from ._colors import COLORS
+from ._crops import WellStore
 
 
 def posTranImg(pos, zoom):
@@ -191,7 +192,9 @@ class PainterLabel(QLabel):
         self.setRectNormal()
 
     def saveEdit(self):
-        edit_path = self.info_c.P_EDIT.format(img_name=self.info_c.img_name_current)
+        img_name = self.info_c.img_name_current
+        edit_path = self.info_c.P_EDIT.format(img_name=img_name)
+        rects = []
         with open(edit_path, "w") as f:
             for rect, clas in self.rect_class_list_edit:
                 pos1 = rect.topLeft()
@@ -199,6 +202,13 @@ class PainterLabel(QLabel):
                 x1, y1 = pos1.x(), pos1.y()
                 x2, y2 = pos2.x(), pos2.y()
                 f.write(f"{x1},{y1},{x2 - x1},{y2 - y1},{clas}\n")
+                rects.append((x1, y1, x2 - x1, y2 - y1))
+
+        # crops of the edited wells are cut now, not when training starts,
+        # relabelling alone keeps the stored ones
+        store = WellStore(self.info_c.P_WELLS)
+        store.load(img_name, "edit", self.info_c.P_IMAGE.format(img_name=img_name), rects)
+        store.flush()
 
     def paintEvent(self, event):
         super(PainterLabel, self).paintEvent(event)
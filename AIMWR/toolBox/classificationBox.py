@@ -7,13 +7,20 @@ from PySide6.QtWidgets import (
     QButtonGroup,
     QRadioButton,
     QProgressBar,
+    QCheckBox,
+    QGroupBox,
+    QLabel,
+    QLineEdit,
+    QComboBox,
 )
-from PySide6.QtCore import Signal
+from PySide6.QtCore import Signal, QSettings
 
 from ._modelGroupBox import ModelGroupBox
 from .._collapsible import QCollapsible
 from ..infoCollector import InfoCollector
-from ..algorithm import ClassifyThread
+from ..algorithm import ClassifyThread, PipelineThread, Extractor
+from .._inference import MODEL_CACHE, PRECISIONS
+from .._optimize import CPU_MODES, isFresh, reportText
 
 
 class ClassificationBox(QCollapsible):
@@ -40,14 +47,62 @@ class ClassificationBox(QCollapsible):
         self.widget.setLayout(self.lay_all)
         self.collapse()
 
-        # widget: box_model + rad_current + rad_unproc + rad_all + btn_classify + bar_classify
+        # widget: box_model + box_params + ckb_extract + radio buttons + btn_classify + bar_classify
         self.box_model = ModelGroupBox("Model")
+
+        # box_params: inference batch size, its memory budget, prefetching, model cache
+        # and optimized CPU graphs
+        self.box_params = QGroupBox("Parameters")
+        self.lay_params = QVBoxLayout()
+        self.box_params.setLayout(self.lay_params)
+        self.lab_batch = QLabel("Batch size (0 for auto):")
+        self.line_batch = QLineEdit()
+        self.lab_memory = QLabel("Memory for auto batch size (MB):")
+        self.line_memory = QLineEdit()
+        self.lab_workers = QLabel("Decode workers (0 for none):")
+        self.line_workers = QLineEdit()
+        self.lab_prefetch = QLabel("Prefetch depth (images):")
+        self.line_prefetch = QLineEdit()
+        self.lab_cpu_mode = QLabel("CPU inference mode:")
+        self.comb_cpu_mode = QComboBox()
+        self.comb_cpu_mode.addItems(CPU_MODES)
+        self.lab_precision = QLabel("Precision (fp32 models):")
+        self.comb_precision = QComboBox()
+        self.comb_precision.addItems(PRECISIONS)
+        self.lab_shards = QLabel("CPU processes (0 for one):")
+        self.line_shards = QLineEdit()
+        self.lab_cache_models = QLabel("Models kept loaded (0 for none):")
+        self.line_cache_models = QLineEdit()
+        self.lab_cache_mb = QLabel("Model cache memory (MB):")
+        self.line_cache_mb = QLineEdit()
+        self.lay_params.addWidget(self.lab_batch)
+        self.lay_params.addWidget(self.line_batch)
+        self.lay_params.addWidget(self.lab_memory)
+        self.lay_params.addWidget(self.line_memory)
+        self.lay_params.addWidget(self.lab_workers)
+        self.lay_params.addWidget(self.line_workers)
+        self.lay_params.addWidget(self.lab_prefetch)
+        self.lay_params.addWidget(self.line_prefetch)
+        self.lay_params.addWidget(self.lab_cpu_mode)
+        self.lay_params.addWidget(self.comb_cpu_mode)
+        self.lay_params.addWidget(self.lab_precision)
+        self.lay_params.addWidget(self.comb_precision)
+        self.lay_params.addWidget(self.lab_shards)
+        self.lay_params.addWidget(self.line_shards)
+        self.lay_params.addWidget(self.lab_cache_models)
+        self.lay_params.addWidget(self.line_cache_models)
+        self.lay_params.addWidget(self.lab_cache_mb)
+        self.lay_params.addWidget(self.line_cache_mb)
+
+        self.ckb_extract = QCheckBox("Extract first (single decode)")
         self.rad_current = QRadioButton("Current")
         self.rad_unproc = QRadioButton("Unprocessed")
         self.rad_all = QRadioButton("All")
         self.btn_classify = QPushButton("Classify")
         self.bar_classify = QProgressBar()
         self.lay_all.addWidget(self.box_model)
+        self.lay_all.addWidget(self.box_params)
+        self.lay_all.addWidget(self.ckb_extract)
         self.lay_all.addWidget(self.rad_current)
         self.lay_all.addWidget(self.rad_unproc)
         self.lay_all.addWidget(self.rad_all)
@@ -68,6 +123,14 @@ class ClassificationBox(QCollapsible):
 
         self.box_model.loadSettings("classification_model")
 
+        # the model cache is shared by the whole app, not per workspace
+        settings = QSettings("AIMWR", "AIMWR")
+        max_models = int(settings.value("model_cache_size", 2))
+        max_mb = int(settings.value("model_cache_mb", 2048))
+        self.line_cache_models.setText(str(max_models))
+        self.line_cache_mb.setText(str(max_mb))
+        MODEL_CACHE.setLimits(max_models, max_mb)
+
     def _initSignals(self):
         self.box_model.model_chosen.connect(self.atModelChosen)
         self.btn_classify.clicked.connect(self.doClassify)
@@ -77,6 +140,62 @@ class ClassificationBox(QCollapsible):
 
     def setInfoCollector(self, info_c: InfoCollector):
         self.info_c = info_c
+        self.line_batch.setText(str(self.info_c.getSetting("classify_batch_size", 0)))
+        self.line_memory.setText(str(self.info_c.getSetting("classify_memory_mb", 1024)))
+        self.line_workers.setText(str(self.info_c.getSetting("classify_workers", 0)))
+        self.line_prefetch.setText(str(self.info_c.getSetting("classify_prefetch", 4)))
+        self.comb_cpu_mode.setCurrentText(self.info_c.getSetting("classify_cpu_mode", "fp32"))
+        self.line_shards.setText(str(self.info_c.getSetting("classify_shards", 0)))
+        self.comb_precision.setCurrentText(self.info_c.getSetting("classify_precision", "fp32"))
+
+    def applyParams(self):
+        try:
+            batch_size = int(self.line_batch.text())
+            memory_mb = int(self.line_memory.text())
+            num_workers = int(self.line_workers.text())
+            prefetch = int(self.line_prefetch.text())
+            num_shards = int(self.line_shards.text())
+            max_models = int(self.line_cache_models.text())
+            max_mb = int(self.line_cache_mb.text())
+        except ValueError:
+            batch_size = -1
+            memory_mb = 0
+            num_workers = 0
+            prefetch = 0
+            num_shards = 0
+            max_models = 0
+            max_mb = 0
+        if (
+            batch_size < 0
+            or memory_mb <= 0
+            or num_workers < 0
+            or prefetch <= 0
+            or num_shards < 0
+            or max_models < 0
+            or max_mb <= 0
+        ):
+            QMessageBox.warning(
+                self.widget,
+                "Warning",
+                "Batch size, workers, processes and cached models must not be negative, "
+                "memory and prefetch depth must be positive.",
+                QMessageBox.Ok,
+            )
+            return False
+
+        settings = QSettings("AIMWR", "AIMWR")
+        settings.setValue("model_cache_size", max_models)
+        settings.setValue("model_cache_mb", max_mb)
+        MODEL_CACHE.setLimits(max_models, max_mb)
+
+        self.info_c.setSetting("classify_batch_size", batch_size)
+        self.info_c.setSetting("classify_memory_mb", memory_mb)
+        self.info_c.setSetting("classify_workers", num_workers)
+        self.info_c.setSetting("classify_prefetch", prefetch)
+        self.info_c.setSetting("classify_cpu_mode", self.comb_cpu_mode.currentText())
+        self.info_c.setSetting("classify_shards", num_shards)
+        self.info_c.setSetting("classify_precision", self.comb_precision.currentText())
+        return True
 
     def setAiContainer(self, ai):
         self.ai = ai
@@ -108,6 +227,29 @@ class ClassificationBox(QCollapsible):
             )
             return
 
+        if not self.applyParams():
+            return
+
+        # static quantization is calibrated on edited wells when first built
+        cpu_mode = self.comb_cpu_mode.currentText()
+        if (
+            cpu_mode == "int8_static"
+            and not isFresh(model_path, cpu_mode)
+            and not self.info_c.getImageNamesByFilter(([True, False], [True, False], [True]))
+        ):
+            QMessageBox.warning(
+                self.widget,
+                "Warning",
+                "Static quantization needs edited wells to calibrate.",
+                QMessageBox.Ok,
+            )
+            return
+
+        # extract and classify in one pass, images need not be extracted
+        if self.ckb_extract.isChecked():
+            self.doExtractClassify(model_path)
+            return
+
         # get image names to classify
         if self.rad_current.isChecked():
             img_names = [self.info_c.img_name_current]
@@ -130,10 +272,70 @@ class ClassificationBox(QCollapsible):
             return
 
         # start classification thread
-        self.ai.thread = ClassifyThread(self.info_c, model_path, img_names, self.parent)
+        self.ai.thread = ClassifyThread(
+            self.info_c,
+            model_path,
+            img_names,
+            self.info_c.getSetting("classify_batch_size", 0),
+            self.info_c.getSetting("classify_memory_mb", 1024),
+            self.info_c.getSetting("classify_workers", 0),
+            self.info_c.getSetting("classify_prefetch", 4),
+            self.info_c.getSetting("classify_cpu_mode", "fp32"),
+            self.info_c.getSetting("classify_shards", 0),
+            self.info_c.getSetting("classify_precision", "fp32"),
+            parent=self.parent,
+        )
+        self.startThread()
+
+    def doExtractClassify(self, model_path):
+        if not self.info_c.hasTemplate():
+            QMessageBox.warning(
+                self.widget, "Warning", "No template image found.", QMessageBox.Ok
+            )
+            return
 
-        # if using CPU, ask for confirmation
-        if self.ai.thread.isUsingCpu():
+        # get image names to extract and classify
+        if self.rad_current.isChecked():
+            img_names = [self.info_c.img_name_current]
+        elif self.rad_unproc.isChecked():
+            img_names = self.info_c.getImageNamesByFilter(
+                ([True, False], [False], [True, False])
+            )  # get unclassified images
+        elif self.rad_all.isChecked():
+            img_names = self.info_c.getImageNames()
+        else:
+            return
+
+        if not img_names:
+            QMessageBox.warning(
+                self.widget, "Warning", "No images to classify.", QMessageBox.Ok
+            )
+            return
+
+        extractor = Extractor(self.info_c.work_dir, self.info_c.P_TEMPLATE)
+        extractor.loadSettings(self.info_c)
+        self.ai.thread = PipelineThread(
+            self.info_c,
+            extractor,
+            model_path,
+            img_names,
+            self.info_c.getSetting("classify_batch_size", 0),
+            self.info_c.getSetting("classify_memory_mb", 1024),
+            self.info_c.getSetting("classify_cpu_mode", "fp32"),
+            self.info_c.getSetting("classify_precision", "fp32"),
+            parent=self.parent,
+        )
+        self.startThread()
+
+    def startThread(self):
+        if self.ai.thread.isUsingCpu() and self.ai.thread.modelPrecision() == "fp16":
+            QMessageBox.warning(
+                self.widget, "Warning", "fp16 needs CUDA, use bf16 on the CPU.", QMessageBox.Ok
+            )
+            return
+
+        # if using CPU without an optimized mode, ask for confirmation
+        if self.ai.thread.isUsingCpu() and self.ai.thread.cpu_mode == "fp32":
             res = QMessageBox.question(
                 self.widget,
                 "Warning",
@@ -159,9 +361,21 @@ class ClassificationBox(QCollapsible):
         self.ai.thread.stop()
 
     def finishClassify(self, num_classified):
-        QMessageBox.information(
-            self.widget, "Info", f"Classification finished. {num_classified} images processed.", QMessageBox.Ok
-        )
+        msg = f"Classification finished. {num_classified} images processed."
+        report = self.ai.thread.timingReport()
+        if report:
+            msg += f"\n{report}"
+        if self.ai.thread.optimize_report is not None:
+            msg += f"\n{reportText(self.ai.thread.cpu_mode, self.ai.thread.optimize_report)}"
+        failed = self.ai.thread.failed
+        if failed:
+            names = ", ".join(img_name for img_name, _ in failed[:10])
+            if len(failed) > 10:
+                names += ", ..."
+            msg += f"\n{len(failed)} images failed: {names}\nFirst error: {failed[0][1]}"
+            QMessageBox.warning(self.widget, "Warning", msg, QMessageBox.Ok)
+        else:
+            QMessageBox.information(self.widget, "Info", msg, QMessageBox.Ok)
         self.bar_classify.setValue(0)
         self.bar_classify.setVisible(False)
         self.classify_finished.emit()
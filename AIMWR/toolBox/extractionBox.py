@@ -6,13 +6,18 @@ from PySide6.QtWidgets import (
     QRadioButton,
     QButtonGroup,
     QMessageBox,
+    QProgressBar,
+    QComboBox,
+    QGroupBox,
+    QLineEdit,
+    QCheckBox,
 )
 from PySide6.QtCore import Signal
 from PySide6.QtGui import QPixmap
 
 from .._collapsible import QCollapsible
 from ..infoCollector import InfoCollector
-from ..algorithm import Extractor
+from ..algorithm import Extractor, ExtractThread
 
 
 class ExtractionBox(QCollapsible):
@@ -45,25 +50,61 @@ class ExtractionBox(QCollapsible):
         self.lay_all.addWidget(self.lab_temp_img)
         self.lay_all.addWidget(self.btn_temp)
 
+        self.comb_mode = QComboBox()
+        self.comb_mode.addItems(["Exhaustive", "Pyramid", "Grid"])
+        self.lay_all.addWidget(self.comb_mode)
+
+        # box_params: match threshold, binarization and response cache
+        self.box_params = QGroupBox("Parameters")
+        self.lay_params = QVBoxLayout()
+        self.box_params.setLayout(self.lay_params)
+        self.lay_all.addWidget(self.box_params)
+
+        self.lab_thre = QLabel("Match threshold:")
+        self.line_thre = QLineEdit()
+        self.lab_block = QLabel("Binarization block size:")
+        self.line_block = QLineEdit()
+        self.lab_c = QLabel("Binarization C:")
+        self.line_c = QLineEdit()
+        self.lab_memory = QLabel("Memory per process (MB, 0 for untiled):")
+        self.line_memory = QLineEdit()
+        self.ckb_cache = QCheckBox("Cache response maps")
+        self.lay_params.addWidget(self.lab_thre)
+        self.lay_params.addWidget(self.line_thre)
+        self.lay_params.addWidget(self.lab_block)
+        self.lay_params.addWidget(self.line_block)
+        self.lay_params.addWidget(self.lab_c)
+        self.lay_params.addWidget(self.line_c)
+        self.lay_params.addWidget(self.lab_memory)
+        self.lay_params.addWidget(self.line_memory)
+        self.lay_params.addWidget(self.ckb_cache)
+
         self.rad_current = QRadioButton("Current")
         self.rad_unproc = QRadioButton("Unprocessed")
+        self.rad_outdated = QRadioButton("Outdated")
         self.rad_all = QRadioButton("All")
         self.lay_all.addWidget(self.rad_current)
         self.lay_all.addWidget(self.rad_unproc)
+        self.lay_all.addWidget(self.rad_outdated)
         self.lay_all.addWidget(self.rad_all)
 
         self.btn_extract = QPushButton("Extract")
+        self.bar_extract = QProgressBar()
         self.lay_all.addWidget(self.btn_extract)
+        self.lay_all.addWidget(self.bar_extract)
+        self.bar_extract.setVisible(False)
 
         self.btngroup = QButtonGroup()
         self.btngroup.addButton(self.rad_current)
         self.btngroup.addButton(self.rad_unproc)
+        self.btngroup.addButton(self.rad_outdated)
         self.btngroup.addButton(self.rad_all)
 
         self.rad_current.setChecked(True)
 
     def _initData(self):
         self.extractor = None
+        self.thread = None
         self.has_template = False
         self.template_path = ""
         self.lab_temp_img.setVisible(self.has_template)
@@ -74,12 +115,58 @@ class ExtractionBox(QCollapsible):
     def _initSignals(self):
         self.btn_extract.clicked.connect(self.doExtract)
         self.btn_temp.clicked.connect(self.start_template_setting.emit)
+        self.comb_mode.currentTextChanged.connect(self.atModeChanged)
 
     def setInfoCollector(self, info_c: InfoCollector):
         self.info_c = info_c
         self.extractor = Extractor(self.info_c.work_dir, self.info_c.P_TEMPLATE)
+        self.extractor.loadSettings(self.info_c)
+        self.comb_mode.blockSignals(True)
+        self.comb_mode.setCurrentText(self.extractor.mode.capitalize())
+        self.comb_mode.blockSignals(False)
+
+        self.line_thre.setText(str(self.info_c.getSetting("match_thre", 0.15)))
+        self.line_block.setText(str(self.info_c.getSetting("block_size", 25)))
+        self.line_c.setText(str(self.info_c.getSetting("block_c", 10)))
+        self.line_memory.setText(str(self.info_c.getSetting("tile_memory_mb", 0)))
+        self.ckb_cache.setChecked(self.info_c.getSetting("cache_response", False))
         self.renewTemplate()
 
+    def atModeChanged(self, text):
+        mode = text.lower()
+        self.extractor.mode = mode
+        self.info_c.setSetting("extract_mode", mode)
+
+    def applyParams(self):
+        try:
+            match_thre = float(self.line_thre.text())
+            block_size = int(self.line_block.text())
+            block_c = float(self.line_c.text())
+            memory_mb = int(self.line_memory.text())
+        except ValueError:
+            match_thre = 0.0
+            block_size = 0
+            memory_mb = -1
+        if match_thre <= 0 or block_size < 3 or block_size % 2 == 0 or memory_mb < 0:
+            QMessageBox.warning(
+                self.widget,
+                "Warning",
+                "Threshold must be positive, block size odd and at least 3, "
+                "memory not negative.",
+                QMessageBox.Ok,
+            )
+            return False
+        if block_c == int(block_c):
+            block_c = int(block_c)
+
+        self.info_c.setSetting("match_thre", match_thre)
+        self.info_c.setSetting("block_size", block_size)
+        self.info_c.setSetting("block_c", block_c)
+        self.info_c.setSetting("tile_memory_mb", memory_mb)
+        self.info_c.setSetting("cache_response", self.ckb_cache.isChecked())
+        self.extractor.loadSettings(self.info_c)
+        return True
+
     def renewTemplate(self):
         # renew template messages
         self.has_template = self.info_c.hasTemplate()
@@ -100,6 +187,12 @@ class ExtractionBox(QCollapsible):
             self.lab_temp_msg.setText("No template image found.")
 
     def doExtract(self):
+        # stop extraction if it is running
+        if self.thread and self.thread.isRunning():
+            self.thread.stop()
+            self.btn_extract.setEnabled(False)
+            return
+
         # check if template image exists
         if not self.info_c.hasTemplate():
             QMessageBox.warning(
@@ -114,33 +207,71 @@ class ExtractionBox(QCollapsible):
             img_names = self.info_c.getImageNamesByFilter(
                 ([False], [True, False], [True, False])
             )
+        elif self.rad_outdated.isChecked():
+            # new images, or images whose image, template or params changed
+            img_names = self.info_c.getImageNames()
         elif self.rad_all.isChecked():
             img_names = self.info_c.getImageNames()
         else:
             return
 
-        # start extraction
-        wells_locs = []
-        for img_name in img_names:
-            wells_locs = self.extractor.wellExtract(img_name)
-            self.writeResult(img_name, wells_locs)
+        # check if there are images to extract
+        if not img_names:
+            QMessageBox.warning(
+                self.widget, "Warning", "No images to extract.", QMessageBox.Ok
+            )
+            return
+
+        if not self.applyParams():
+            return
+
+        # start extraction thread
+        self.thread = ExtractThread(
+            self.info_c,
+            self.extractor,
+            img_names,
+            incremental=self.rad_outdated.isChecked(),
+            parent=self.widget,
+        )
+        self.thread.finished.connect(self.finishExtract)
+        self.thread.complete.connect(self.updateBar)
+        self.thread.start()
+
+        self.btn_extract.setText("Stop")
+        self.bar_extract.setValue(0)
+        self.bar_extract.setVisible(True)
+
+    def updateBar(self, idx, num):
+        self.bar_extract.setValue(idx / num * 100)
+
+    def finishExtract(self, num_extracted):
+        self.btn_extract.setText("Extract")
+        self.btn_extract.setEnabled(True)
+        self.bar_extract.setValue(0)
+        self.bar_extract.setVisible(False)
 
         # show message box
-        if len(img_names) > 1:
+        failed = self.thread.failed
+        if failed:
+            names = ", ".join(img_name for img_name, _ in failed[:10])
+            if len(failed) > 10:
+                names += ", ..."
+            QMessageBox.warning(
+                self.widget,
+                "Warning",
+                f"Extraction finished. {num_extracted} images processed, "
+                f"{self.thread.num_skipped} of them already up to date. "
+                f"{len(failed)} images failed: {names}\n"
+                f"First error: {failed[0][1]}",
+                QMessageBox.Ok,
+            )
+        elif len(self.thread.img_names) > 1:
             QMessageBox.information(
                 self.widget,
                 "Info",
-                f"Extraction finished. {len(img_names)} images processed.",
+                f"Extraction finished. {num_extracted} images processed, "
+                f"{self.thread.num_skipped} of them already up to date.",
                 QMessageBox.Ok,
             )
 
         self.finish_extraction.emit()
-
-    def writeResult(self, img_name, wells_loc):
-        with open(self.info_c.P_EXTARCT.format(img_name=img_name), "w") as f:
-            for loc in wells_loc:
-                x = loc[0]
-                y = loc[1]
-                w = self.extractor.t.shape[1]
-                h = self.extractor.t.shape[0]
-                f.write(f"{x},{y},{w},{h},{-1}\n")
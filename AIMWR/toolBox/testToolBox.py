@@ -78,7 +78,17 @@ class TestToolBox(QCollapsible):
             )
             return
 
-        self.ai.thread = ClassifyThread(self.info_c, model_path, self.widget)
+        # classify the edited images again, the model stays loaded between tests
+        img_names = self.info_c.getImageNamesByFilter(([True], [True, False], [True]))
+        if not img_names:
+            QMessageBox.warning(
+                self.widget, "Warning", "No edited images to test.", QMessageBox.Ok
+            )
+            return
+
+        self.ai.thread = ClassifyThread(
+            self.info_c, model_path, img_names, parent=self.widget
+        )
         if self.ai.thread.isUsingCpu():
             res = QMessageBox.question(
                 self.widget,
@@ -93,6 +103,7 @@ class TestToolBox(QCollapsible):
         self.ai.thread.start()
 
     def atClassifyFinished(self):
+        self.info_c.renewStatus()
         self.countResult()
         QMessageBox.information(self.widget, "Info", "Test finished.", QMessageBox.Ok)
         self.lab_result.setText("Test finished.")
@@ -1,3 +1,4 @@
+import os
 from PySide6.QtWidgets import (
     QWidget,
     QVBoxLayout,
@@ -8,12 +9,16 @@ from PySide6.QtWidgets import (
     QComboBox,
     QLineEdit,
     QMessageBox,
+    QCheckBox,
 )
 
 from ._modelGroupBox import ModelGroupBox
 from .._collapsible import QCollapsible
 from ..infoCollector import InfoCollector
-from ..algorithm import TrainThread
+from ..algorithm import TrainThread, HeadTrainThread
+from .._nets import MODELS, HEADS
+from .._inference import PRECISIONS
+from .._checkpoint import stoppedCheckpoint
 
 
 class TrainToolBox(QCollapsible):
@@ -54,9 +59,16 @@ class TrainToolBox(QCollapsible):
         self.box_params.setLayout(self.lay_params)
 
         self.comb_model = QComboBox()
-        self.comb_model.addItems(["MobileNet", "ResNet18", "ResNet50"])
+        self.comb_model.addItems(list(MODELS))
         self.lay_params.addWidget(self.comb_model)
 
+        # only a new head on cached features of the chosen model
+        self.ckb_fast = QCheckBox("Fast retrain (head only, needs a model)")
+        self.comb_head = QComboBox()
+        self.comb_head.addItems(HEADS)
+        self.lay_params.addWidget(self.ckb_fast)
+        self.lay_params.addWidget(self.comb_head)
+
         self.lab_epoch = QLabel("Max epochs:")
         self.line_epoch = QLineEdit()
         self.lab_batch = QLabel("Batch size:")
@@ -66,6 +78,51 @@ class TrainToolBox(QCollapsible):
         self.lay_params.addWidget(self.lab_batch)
         self.lay_params.addWidget(self.line_batch)
 
+        self.lab_val = QLabel("Validation images (%):")
+        self.line_val = QLineEdit()
+        self.lab_patience = QLabel("Early stop patience (epochs, 0 for none):")
+        self.line_patience = QLineEdit()
+        self.lay_params.addWidget(self.lab_val)
+        self.lay_params.addWidget(self.line_val)
+        self.lay_params.addWidget(self.lab_patience)
+        self.lay_params.addWidget(self.line_patience)
+
+        self.lab_keep = QLabel("Checkpoints kept:")
+        self.line_keep = QLineEdit()
+        self.ckb_resume = QCheckBox("Resume the last stopped run")
+        self.lay_params.addWidget(self.lab_keep)
+        self.lay_params.addWidget(self.line_keep)
+        self.lay_params.addWidget(self.ckb_resume)
+
+        self.lab_precision = QLabel("Precision:")
+        self.comb_precision = QComboBox()
+        self.comb_precision.addItems(PRECISIONS)
+        self.lay_params.addWidget(self.lab_precision)
+        self.lay_params.addWidget(self.comb_precision)
+
+        self.ckb_batch_augment = QCheckBox("Augment whole batches")
+        self.ckb_lazy = QCheckBox("Read wells from disk (large workspaces)")
+        self.lay_params.addWidget(self.ckb_batch_augment)
+        self.lay_params.addWidget(self.ckb_lazy)
+
+        # data loading in worker processes
+        self.lab_workers = QLabel("Loader workers (-1 for auto):")
+        self.line_workers = QLineEdit()
+        self.lab_prefetch = QLabel("Prefetch batches per worker:")
+        self.line_prefetch = QLineEdit()
+        self.lab_processes = QLabel("Training processes (CPU, batch size each):")
+        self.line_processes = QLineEdit()
+        self.ckb_pin = QCheckBox("Pinned memory (CUDA)")
+        self.ckb_persistent = QCheckBox("Keep workers between epochs")
+        self.lay_params.addWidget(self.lab_workers)
+        self.lay_params.addWidget(self.line_workers)
+        self.lay_params.addWidget(self.lab_prefetch)
+        self.lay_params.addWidget(self.line_prefetch)
+        self.lay_params.addWidget(self.lab_processes)
+        self.lay_params.addWidget(self.line_processes)
+        self.lay_params.addWidget(self.ckb_pin)
+        self.lay_params.addWidget(self.ckb_persistent)
+
     def _initData(self):
         self.model_msg = "No model loaded."
         self.box_model.lab_msg.setText(self.model_msg)
@@ -80,6 +137,16 @@ class TrainToolBox(QCollapsible):
 
     def setInfoCollector(self, info_c: InfoCollector):
         self.info_c = info_c
+        self.line_workers.setText(str(self.info_c.getSetting("train_workers", -1)))
+        self.line_prefetch.setText(str(self.info_c.getSetting("train_prefetch", 2)))
+        self.ckb_pin.setChecked(self.info_c.getSetting("train_pin_memory", True))
+        self.ckb_persistent.setChecked(self.info_c.getSetting("train_persistent_workers", True))
+        self.line_val.setText(str(self.info_c.getSetting("train_val_percent", 20)))
+        self.line_patience.setText(str(self.info_c.getSetting("train_patience", 10)))
+        self.line_keep.setText(str(self.info_c.getSetting("train_keep_checkpoints", 3)))
+        self.comb_precision.setCurrentText(self.info_c.getSetting("train_precision", "fp32"))
+        self.line_processes.setText(str(self.info_c.getSetting("train_processes", 1)))
+        self.comb_head.setCurrentText(self.info_c.getSetting("train_head", "linear"))
 
     def setAiContainer(self, ai):
         self.ai = ai
@@ -91,8 +158,9 @@ class TrainToolBox(QCollapsible):
         if not model_path:
             return
 
-        model_name = model_path.split("/")[-1]
-        self.pre_model_type = model_name.split("_")[-1]
+        # model files are named {model_type}_{time}.pth
+        model_name = os.path.basename(model_path)
+        self.pre_model_type = model_name.split("_")[0]
         self.comb_model.setCurrentText(self.pre_model_type)
 
     def train(self):
@@ -109,13 +177,126 @@ class TrainToolBox(QCollapsible):
         if not model_path:
             model_type = self.comb_model.currentText()
         else:
-            model_type = self.pre_model_type
+            # also for a model restored from the settings, not chosen this session
+            model_type = os.path.basename(model_path).split("_")[0]
         max_epoch = int(self.line_epoch.text())
         batch_size = int(self.line_batch.text())
+        try:
+            num_workers = int(self.line_workers.text())
+            prefetch = int(self.line_prefetch.text())
+            val_percent = int(self.line_val.text())
+            patience = int(self.line_patience.text())
+            keep = int(self.line_keep.text())
+            num_processes = int(self.line_processes.text())
+        except ValueError:
+            num_workers, prefetch, val_percent, patience, keep = -2, 0, -1, -1, 0
+            num_processes = 0
+        if (
+            num_workers < -1
+            or prefetch <= 0
+            or not 0 <= val_percent < 100
+            or patience < 0
+            or keep <= 0
+            or num_processes <= 0
+        ):
+            QMessageBox.warning(
+                self.widget,
+                "Warning",
+                "Loader workers must be -1 or more, prefetch, kept checkpoints and "
+                "processes must be positive, validation from 0 to 99% and patience "
+                "not negative.",
+                QMessageBox.Ok,
+            )
+            return
+
+        if self.ckb_fast.isChecked() and not model_path:
+            QMessageBox.warning(
+                self.widget, "Warning", "Fast retrain needs a trained model.", QMessageBox.Ok
+            )
+            return
+
+        resume_path = ""
+        if self.ckb_resume.isChecked() and not self.ckb_fast.isChecked():
+            resume = stoppedCheckpoint(os.path.dirname(self.info_c.P_CHECKPOINT))
+            if resume is None:
+                QMessageBox.warning(
+                    self.widget, "Warning", "No stopped run to resume.", QMessageBox.Ok
+                )
+                return
+            # the run goes on with its own model, not the one chosen above
+            res = QMessageBox.question(
+                self.widget,
+                "Resume",
+                f"Resume the {resume['model_type']} run of {resume['time']} after "
+                f"epoch {resume['epoch']}, up to {max_epoch} epochs? The model and "
+                "precision chosen here are not used.",
+                QMessageBox.Yes | QMessageBox.No,
+            )
+            if res == QMessageBox.No:
+                return
+            resume_path = resume["path"]
+
+        self.info_c.setSetting("train_workers", num_workers)
+        self.info_c.setSetting("train_prefetch", prefetch)
+        self.info_c.setSetting("train_pin_memory", self.ckb_pin.isChecked())
+        self.info_c.setSetting("train_persistent_workers", self.ckb_persistent.isChecked())
+        self.info_c.setSetting("train_val_percent", val_percent)
+        self.info_c.setSetting("train_patience", patience)
+        self.info_c.setSetting("train_keep_checkpoints", keep)
+        self.info_c.setSetting("train_precision", self.comb_precision.currentText())
+        self.info_c.setSetting("train_processes", num_processes)
+        self.info_c.setSetting("train_head", self.comb_head.currentText())
+        self.max_epoch = max_epoch
+
+        if self.ckb_fast.isChecked():
+            self.ai.thread = HeadTrainThread(
+                self.info_c,
+                model_path,
+                model_type,
+                max_epoch,
+                batch_size,
+                self.comb_head.currentText(),
+                val_percent,
+                patience,
+                parent=self.parent,
+            )
+            self.ai.thread.finished.connect(self.finishTrain)
+            self.ai.thread.complete.connect(self.updateBar)
+            self.ai.thread.validated.connect(self.updateValidation)
+            self.ai.thread.start()
+            return
 
         self.ai.thread = TrainThread(
-            self.info_c, model_path, model_type, max_epoch, batch_size, self.parent
+            self.info_c,
+            model_path,
+            model_type,
+            max_epoch,
+            batch_size,
+            self.ckb_batch_augment.isChecked(),
+            self.ckb_lazy.isChecked(),
+            num_workers,
+            prefetch,
+            self.ckb_pin.isChecked(),
+            self.ckb_persistent.isChecked(),
+            val_percent,
+            patience,
+            keep,
+            resume_path,
+            self.comb_precision.currentText(),
+            num_processes,
+            parent=self.parent,
         )
+        if self.ai.thread.isUsingCpu() and resume_path and resume["precision"] == "fp16":
+            QMessageBox.warning(
+                self.widget, "Warning", "The run was trained with fp16, which needs CUDA.",
+                QMessageBox.Ok,
+            )
+            return
+        if self.ai.thread.isUsingCpu() and not resume_path and self.ai.thread.precision == "fp16":
+            QMessageBox.warning(
+                self.widget, "Warning", "fp16 needs CUDA, use bf16 on the CPU.", QMessageBox.Ok
+            )
+            return
         if self.ai.thread.isUsingCpu():
             res = QMessageBox.question(
                 self.widget,
@@ -128,15 +309,37 @@ class TrainToolBox(QCollapsible):
 
         self.ai.thread.finished.connect(self.finishTrain)
         self.ai.thread.complete.connect(self.updateBar)
+        self.ai.thread.validated.connect(self.updateValidation)
         self.ai.thread.start()
 
     def finishTrain(self):
-        QMessageBox.information(
-            self.widget, "Info", "Training finished.", QMessageBox.Ok
-        )
-        self.lab_result.setText("Training finished. Model saved.")
+        msg = "Training finished. Model saved."
+        if self.ai.thread.error:
+            msg = f"Training failed: {self.ai.thread.error}"
+            QMessageBox.warning(self.widget, "Warning", msg, QMessageBox.Ok)
+        else:
+            QMessageBox.information(
+                self.widget, "Info", "Training finished.", QMessageBox.Ok
+            )
+        if self.ai.thread.train_report:
+            msg += "\n" + self.ai.thread.trainText()
+        report = self.ai.thread.dataset_report
+        if report:
+            msg += (
+                f"\nDataset: {report['wells']} training and {report['val_wells']} validation "
+                f"wells, built in {report['seconds']:.1f}s, "
+                f"peak RSS {report['peak_rss_mb']:.0f} MB."
+            )
+        if self.ai.thread.loader_report:
+            msg += "\n" + self.ai.thread.loaderText()
+        self.lab_result.setText(msg)
         self.bar_train.setValue(0)
 
     def updateBar(self, epoch, idx, loss):
-        self.bar_train.setValue(epoch / self.max_epoch * 100)
+        self.bar_train.setValue(int(epoch / self.max_epoch * 100))
         self.lab_result.setText(f"Epoch: {epoch}, Loss: {loss:.3f}")
+
+    def updateValidation(self, epoch, loss, accuracy):
+        self.lab_result.setText(
+            f"Epoch: {epoch}, validation loss: {loss:.3f}, accuracy: {accuracy * 100:.1f}%"
+        )